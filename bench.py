@@ -0,0 +1,341 @@
+#!/usr/bin/env python2
+
+"""Benchmarks.
+
+Command generate creates a synthetic database, run times the scenarios and
+writes the results as JSON, and compare shows the change between two
+result files.
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import cgi
+import codecs
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import timeit
+
+import bench_server
+import feed_db
+import feed_tool
+import html
+import reader
+import util
+
+DBFILE = '_bench.db'  # Default synthetic database filename.
+DESCRIPTION = ('<p>Some <b>text</b> about the {t}, with a <a href="{l}">'
+               'link</a> &amp; more.</p>\n') * 10
+WORDS = ('apple banana cherry delta echo foxtrot golf hotel india juliet '
+         'kilo lima mike november oscar papa quebec romeo sierra').split()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    sub = p.add_subparsers(dest='command')
+    g = sub.add_parser('generate', help='create synthetic database')
+    g.add_argument('file', metavar='DB_FILE', nargs='?', default=DBFILE,
+                   help='Database file name')
+    add_size_args(g)
+    r = sub.add_parser('run', help='run benchmarks')
+    r.add_argument('file', metavar='DB_FILE', nargs='?', default=DBFILE,
+                   help='Database file name, generated if missing')
+    add_size_args(r)
+    r.add_argument('--only', nargs='+', metavar='GROUP',
+                   choices=sorted(SCENARIOS),
+                   help='run only these scenario groups')
+    r.add_argument('--repeat', type=int, default=3,
+                   help='number of timed runs, the best one counts')
+    r.add_argument('--refresh-feeds', type=int, default=200,
+                   help='number of fixture feeds to refresh')
+    r.add_argument('--latency', type=float, default=0.02,
+                   help='seconds fixture server delays each response')
+    r.add_argument('--errors', type=float, default=0.05,
+                   help='fraction of fixture feeds that fail')
+    r.add_argument('--jobs', '-j', type=int, default=16,
+                   help='number of concurrent fetches when refreshing')
+    r.add_argument('--rows', type=int, default=5000,
+                   help='number of rows in the rendered table')
+    r.add_argument('--output', '-o', metavar='JSON_FILE',
+                   help='write results to file')
+    c = sub.add_parser('compare', help='compare two result files')
+    c.add_argument('old', metavar='JSON_FILE')
+    c.add_argument('new', metavar='JSON_FILE')
+    c.add_argument('--threshold', type=float, default=1.2,
+                   help='slowdown ratio that counts as regression')
+    return p.parse_args()
+
+
+def add_size_args(p):
+    p.add_argument('--feeds', type=int, default=5000,
+                   help='number of synthetic feeds')
+    p.add_argument('--entries', type=int, default=2000000,
+                   help='number of synthetic entries')
+    p.add_argument('--categories', type=int, default=20,
+                   help='number of synthetic categories')
+
+
+def generate(filename, n_feeds, n_entries, n_cats, seed=0):
+    """Create a database with synthetic feeds and entries.
+
+    Entries are spread evenly over the feeds and over the past year; three
+    out of four are read.
+    """
+    rnd = random.Random(seed)
+    now = util.now()
+    year = 365 * 24 * 60 * 60
+    db = feed_db.FeedDb(filename)
+
+    def insert_feeds():
+        db.cur.executemany("""
+            INSERT INTO Feeds(url, title, description, summary, link,
+                category, priority, refreshed, updated)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, ((u'http://example.com/{}'.format(i), u'Feed {}'.format(i),
+                   u'<p>Feed {}</p>'.format(i), u'Feed {}'.format(i),
+                   u'http://example.com/', u'cat{}'.format(i % n_cats),
+                   i % 3, now, now) for i in range(n_feeds)))
+
+    def insert_entries(start, stop):
+        rows = []
+        for i in range(start, stop):
+            title = u' '.join(rnd.sample(WORDS, 4))
+            link = u'http://example.com/e/{}'.format(i)
+            description = DESCRIPTION.format(t=title, l=link)
+            rows.append((i + 1, u'synthetic-{}'.format(i), i % n_feeds + 1,
+                         now, now - rnd.randrange(year), title, description,
+                         util.plaintext(description, 500), link,
+                         int(rnd.random() < 0.75)))
+        db.cur.executemany("""
+            INSERT INTO Entries(id, guid, feed_id, refreshed, updated, title,
+                summary, link, progress)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (r[:6] + r[7:] for r in rows))
+        db.cur.executemany("""
+            INSERT INTO EntryContent(entry_id, description)
+            VALUES(?, deflate(?))
+            """, ((r[0], r[6]) for r in rows))
+
+    db.write(insert_feeds)
+    for start in range(0, n_entries, 10000):
+        db.write(insert_entries, start, min(start + 10000, n_entries))
+    db.close()
+
+
+def best(func, repeat):
+    """Return the shortest time of running func, in seconds."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def concat_table(rows, headers=None):
+    """Build table by string concatenation, as html.table used to."""
+    s = '\n'
+    if headers:
+        row = ''.join(html.tag('th', s) for s in headers)
+        s += html.IND + html.tag('tr', row) + '\n'
+    for items in rows:
+        row = ''.join(html.tag('td', s) for s in items)
+        s += html.IND + html.tag('tr', row) + '\n'
+    return html.tag('table', s)
+
+
+def render(db, query, out=None, bufsize=html.BUFSIZE):
+    """Render reader page for a query string."""
+    args = reader.make_args('bench')
+    environ = dict(REQUEST_METHOD='GET', QUERY_STRING=query)
+    args.parse_form(cgi.FieldStorage(environ=environ))
+    chunks = []
+    r = reader.Reader(args, db, out or chunks.append)
+    r.writer.size = bufsize
+    r.run()
+
+
+def bench_queries(args, db):
+    """Time frequent queries."""
+    feeds = db.get_feeds()
+    f = feeds[len(feeds) // 2]
+    deep = db.get_next(limit=0, with_feed=True)[-50]
+    queries = [
+        ('get_next', dict(limit=50)),
+        ('get_next_noprio', dict(limit=50, priority=False)),
+        ('get_next_cat', dict(limit=50, cat=f['category'])),
+        ('get_next_feed', dict(limit=50, feed=f['id'])),
+        ('get_next_read', dict(limit=50, maxprg=1)),
+        ('get_next_deep', dict(limit=50, after=feed_db.entry_key(deep))),
+        ]
+    for name, kwargs in queries:
+        kwargs['with_feed'] = True
+        yield name, best(lambda: db.get_next(**kwargs), args.repeat)
+    counts = [
+        ('n_entries_unread', dict(maxprg=0)),
+        ('n_entries_all', dict(maxprg=1)),
+        ('n_entries_cat', dict(cat=f['category'])),
+        ('n_entries_feed', dict(feed=f['id'])),
+        ('n_entries_range', dict(minprg=1, maxprg=1)),
+        ]
+    for name, kwargs in counts:
+        yield name, best(lambda: db.n_entries(**kwargs), args.repeat)
+    yield 'category_stats', best(db.category_stats, args.repeat)
+    yield 'feed_stats', best(db.feed_stats, args.repeat)
+    yield 'search', best(lambda: db.search(u'apple banana', limit=20),
+                         args.repeat)
+    yield 'n_matches', best(lambda: db.n_matches(u'apple banana'),
+                            args.repeat)
+
+
+def bench_pages(args, db):
+    """Time reader actions."""
+    cat = db.get_categories()[0]
+    pages = [
+        ('page_cats', 'action=cats'),
+        ('page_feeds', 'action=feeds'),
+        ('page_feeds_cat', 'action=feeds&cat={}'.format(cat)),
+        ('page_entries', 'action=entries&limit=50'),
+        ('page_entries_cat', 'action=entries&limit=50&cat={}'.format(cat)),
+        ('page_search', 'action=search&q=apple+banana&limit=50'),
+        ('page_redirect', 'action=redirect'),  # Marks an entry read.
+        ]
+    for name, query in pages:
+        yield name, best(lambda: render(db, query), args.repeat)
+
+
+def bench_render(args, db):
+    """Time HTML generation."""
+    rows = [['<a href="x">{}</a>'.format(i), str(i), str(i * 2), '&nbsp;']
+            for i in range(args.rows)]
+    headers = ['Category', 'Feeds', 'Unread', 'Total']
+    yield 'table_concat', best(lambda: concat_table(rows, headers),
+                               args.repeat)
+    yield 'table_generator', best(lambda: html.table(rows, headers),
+                                  args.repeat)
+    query = 'action=entries&limit=200&maxprg=1'
+    with open(os.devnull, 'wb') as f:
+        out = codecs.getwriter('utf-8')(f).write
+        yield 'page_unbuffered', best(lambda: render(db, query, out, 0),
+                                      args.repeat)
+        yield 'page_buffered', best(lambda: render(db, query, out),
+                                    args.repeat)
+
+
+def check_links(db):
+    """Fail unless relative guids and links were resolved in refreshing."""
+    row = db.conn.execute("""
+        SELECT guid, link FROM Entries
+        WHERE guid NOT LIKE 'http%' OR link NOT LIKE 'http%' LIMIT 1
+        """).fetchone()
+    if row is not None:
+        raise SystemExit('Relative guid or link: {} {}'.format(*row))
+
+
+def bench_refresh(args, db):
+    """Time refreshing feeds from the fixture server."""
+    server = bench_server.start(latency=args.latency, errors=args.errors)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for jobs in sorted(set([1, args.jobs])):
+            filename = os.path.join(tmpdir, '{}.db'.format(jobs))
+            refresh_db = feed_db.FeedDb(filename)
+            for i in range(args.refresh_feeds):
+                kind = ('rss', 'atom')[i % 2]
+                refresh_db.add_feed(server.url(kind, i), 'bench', 0)
+            # Parse failures must be reported, not hang the pipeline.
+            refresh_db.add_feed(server.url('broken', 0), 'bench', 0)
+            refresh_db.commit()
+            for name in ('cold', 'warm'):
+                t = timeit.default_timer()
+                feed_tool.refresh(refresh_db, [], 0, jobs=jobs)
+                yield ('refresh_{}_j{}'.format(name, jobs),
+                       timeit.default_timer() - t)
+            check_links(refresh_db)
+            refresh_db.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpdir)
+
+
+# Scenario groups, each yielding (name, seconds).
+SCENARIOS = dict(
+    queries=bench_queries,
+    pages=bench_pages,
+    render=bench_render,
+    refresh=bench_refresh,
+    )
+
+
+def git_commit():
+    """Return current commit id, or None if not known."""
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            s = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                        stderr=devnull)
+        return s.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """Run scenarios, print and save results."""
+    if not os.path.exists(args.file):
+        print('Generating {}...'.format(args.file))
+        generate(args.file, args.feeds, args.entries, args.categories)
+    db = feed_db.FeedDb(args.file)
+    d = dict(
+        commit=git_commit(),
+        time=util.time_fmt(fmt='iso8601'),
+        python=platform.python_version(),
+        sqlite=sqlite3.sqlite_version,
+        n_feeds=db.n_feeds(),
+        n_entries=db.n_entries(maxprg=1),
+        params=dict((k, v) for k, v in vars(args).items()
+                    if k not in ('command', 'output')),
+        results={},
+        )
+    for group in args.only or sorted(SCENARIOS):
+        for name, seconds in SCENARIOS[group](args, db):
+            print('{:24} {:10.2f} ms'.format(name, seconds * 1000))
+            d['results'][name] = seconds
+    db.close()
+    if args.output:
+        with open(args.output, 'wb') as f:
+            json.dump(d, f, indent=2, sort_keys=True)
+
+
+def compare(args):
+    """Print time ratios of two result files, exit with error if slower."""
+    with open(args.old, 'rb') as f:
+        old = json.load(f)
+    with open(args.new, 'rb') as f:
+        new = json.load(f)
+    print('{:24} {:>10} {:>10} {:>7}'.format('', str(old['commit'])[:8],
+                                             str(new['commit'])[:8], 'ratio'))
+    slower = []
+    for name in sorted(set(old['results']) & set(new['results'])):
+        a, b = old['results'][name], new['results'][name]
+        ratio = b / a if a else float('inf')
+        print('{:24} {:10.2f} {:10.2f} {:7.2f}'.format(name, a * 1000,
+                                                       b * 1000, ratio))
+        if ratio > args.threshold:
+            slower.append(name)
+    if slower:
+        raise SystemExit('Slower: {}'.format(', '.join(slower)))
+
+
+def main():
+    util.install_utf8_conversion()
+    args = parse_args()
+    if args.command == 'generate':
+        generate(args.file, args.feeds, args.entries, args.categories)
+    elif args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python2
+
+"""HTTP server of synthetic fixture feeds for benchmarks.
+
+Path /rss/N or /atom/N serves feed number N. Every feed has a fixed ETag,
+so a refresh that sends it back gets 304. A given fraction of the feeds
+answer with an error instead, and every response can be delayed. Path
+/broken/N serves a feed whose item has neither guid nor link, which fails
+in parsing. RSS items have relative guids and links, to be resolved against
+the feed URL.
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+
+ITEMS = 20  # Default number of items per feed.
+
+RSS = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel>
+<title>Feed {n}</title><link>http://example.com/{n}/</link>
+<description>Synthetic feed number {n}.</description>
+<ttl>60</ttl>
+{items}
+</channel></rss>"""
+RSS_ITEM = """<item>
+<title>Item {i} of feed {n}</title><guid>rss-{n}-{i}</guid>
+<link>/rss/{n}/{i}</link>
+<description>&lt;p&gt;Text of &lt;b&gt;item {i}&lt;/b&gt; of feed {n}.
+Lorem ipsum dolor sit amet, consectetur adipiscing elit.&lt;/p&gt;
+</description>
+<pubDate>{date}</pubDate>
+</item>"""
+BROKEN_ITEM = """<item>
+<title>Item {i} of feed {n}</title><description>No id.</description>
+</item>"""
+ATOM = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<title>Feed {n}</title><link href="http://example.com/{n}/"/>
+<id>atom-{n}</id><updated>{date}</updated>
+<subtitle>Synthetic feed number {n}.</subtitle>
+{items}
+</feed>"""
+ATOM_ITEM = """<entry>
+<title>Item {i} of feed {n}</title><id>atom-{n}-{i}</id>
+<link href="http://example.com/{n}/{i}"/>
+<updated>{date}</updated>
+<content type="html">&lt;p&gt;Text of &lt;b&gt;item {i}&lt;/b&gt; of feed
+{n}.&lt;/p&gt;</content>
+</entry>"""
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('--host', default='127.0.0.1',
+                   help='host name to listen on')
+    p.add_argument('--port', type=int, default=8765,
+                   help='port to listen on')
+    p.add_argument('--items', type=int, default=ITEMS,
+                   help='number of items per feed')
+    p.add_argument('--latency', type=float, default=0,
+                   help='seconds to delay each response')
+    p.add_argument('--errors', type=float, default=0,
+                   help='fraction of feeds that fail')
+    return p.parse_args()
+
+
+def render(kind, n, items):
+    """Return feed document number n."""
+    day = 24 * 60 * 60
+    times = [1500000000 + n * 60 + i * day for i in range(items)]
+    if kind == 'atom':
+        doc, item, fmt = ATOM, ATOM_ITEM, '%Y-%m-%dT%H:%M:%SZ'
+    elif kind == 'broken':
+        doc, item, fmt = RSS, BROKEN_ITEM, ''
+    else:
+        doc, item, fmt = RSS, RSS_ITEM, '%a, %d %b %Y %H:%M:%S GMT'
+    entries = [item.format(n=n, i=i, date=time.strftime(fmt, time.gmtime(t)))
+               for i, t in enumerate(times)]
+    date = time.strftime(fmt, time.gmtime(times[-1] if times else 0))
+    return doc.format(n=n, items='\n'.join(entries), date=date)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive.
+    wbufsize = -1  # Send each response at once, flushed after the request.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body='', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.count()
+        if server.latency:
+            time.sleep(server.latency)
+        try:
+            kind, n = self.path.strip('/').split('/')
+            n = int(n)
+        except ValueError:
+            return self.send(404)
+        if kind not in ('rss', 'atom', 'broken'):
+            return self.send(404)
+        if n % 100 < server.errors * 100:
+            return self.send(500)
+        etag = '"{}-{}"'.format(kind, n)
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, headers=[('ETag', etag)])
+        body = render(kind, n, server.items)
+        self.send(200, body, [('Content-Type', 'application/xml'),
+                              ('ETag', etag)])
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Fixture feed server with response settings."""
+    daemon_threads = True
+
+    def __init__(self, address, items=ITEMS, latency=0, errors=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.items = items
+        self.latency = latency
+        self.errors = errors
+        self.lock = threading.Lock()
+        self.n_requests = 0
+
+    def count(self):
+        with self.lock:
+            self.n_requests += 1
+
+    def url(self, kind, n):
+        host, port = self.server_address
+        return 'http://{}:{}/{}/{}'.format(host, port, kind, n)
+
+
+def start(items=ITEMS, latency=0, errors=0):
+    """Start server on a free port in a background thread, return it."""
+    server = Server(('127.0.0.1', 0), items=items, latency=latency,
+                    errors=errors)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+def main():
+    args = parse_args()
+    server = Server((args.host, args.port), items=args.items,
+                    latency=args.latency, errors=args.errors)
+    print('Serving feeds on {}'.format(server.url('rss', 0)))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ from doit.tools import Interactive
 
 
 DOIT_CONFIG = {
-    'default_tasks': ['check'],
+    'default_tasks': ['check', 'plans'],
     }
 
 CHECKERS = [
@@ -20,7 +20,9 @@ CHECKERS = [
     # 'pychecker',
     ]
 
-SRC = ['feed_db.py', 'feed_tool.py', 'feed_util.py', 'html.py', 'util.py',
+SRC = ['feed_cache.py', 'feed_db.py', 'feed_fetch.py', 'feed_io.py',
+       'feed_refresh.py', 'feed_schedule.py', 'feed_stats.py', 'feed_tool.py',
+       'feed_util.py', 'html.py', 'util.py', 'reader.py', 'reader_wsgi.py',
        'reader.cgi', 'reader.css']
 
 
@@ -41,6 +43,25 @@ def task_check():
             }
 
 
+def task_plans():
+    """Check that frequent queries use indexes."""
+    return {
+        'actions': ['python2 feed_tool.py :memory: --check-plans'],
+        'file_dep': ['feed_db.py', 'feed_tool.py'],
+        'verbosity': 2,
+        }
+
+
+def task_bench():
+    """Run benchmarks, save results for comparing with later runs."""
+    return {
+        'actions': ['python2 bench.py run --output bench.json'],
+        'targets': ['bench.json'],
+        'verbosity': 2,
+        'uptodate': [False],
+        }
+
+
 def task_commit():
     """Commit."""
     return {
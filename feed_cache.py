@@ -0,0 +1,194 @@
+"""Content-addressed cache of raw feed documents on disk.
+
+Bodies are stored zlib-compressed under their SHA-1, so identical documents
+are stored once. An index database keeps the newest bodies of each feed
+URL with their response headers, so that feeds can be parsed again without
+fetching. The total size is capped by evicting the least recently used
+bodies.
+"""
+
+from __future__ import absolute_import, division, print_function
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+import feed_fetch
+import util
+
+KEEP = 3  # Default number of bodies to keep per feed.
+MAX_SIZE = 100 * 1024 * 1024  # Default cap of compressed bytes stored.
+LEVEL = 6  # Compression level.
+
+CREATE_INDEX = """
+    CREATE TABLE IF NOT EXISTS Bodies(
+        hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        used INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS Bodies_used ON Bodies(used);
+    CREATE TABLE IF NOT EXISTS Responses(
+        id INTEGER PRIMARY KEY,
+        url TEXT NOT NULL,
+        hash TEXT NOT NULL REFERENCES Bodies(hash),
+        fetched INTEGER NOT NULL,
+        status INTEGER NOT NULL,
+        headers TEXT NOT NULL,
+        href TEXT
+    );
+    CREATE INDEX IF NOT EXISTS Responses_url ON Responses(url, fetched);
+    CREATE INDEX IF NOT EXISTS Responses_hash ON Responses(hash);
+    """
+
+
+class BodyCache(object):
+    """Raw body store in a directory, usable from several threads."""
+    def __init__(self, directory, keep=KEEP, max_size=MAX_SIZE):
+        self.directory = directory
+        self.keep = keep
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(directory, 'index.db')
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(CREATE_INDEX)
+        self.total = self.total_size()  # Kept up to date by store().
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def total_size(self):
+        return util.sole(self.conn.execute("""
+            SELECT COALESCE(SUM(size), 0) FROM Bodies
+            """).fetchone())
+
+    def store(self, response):
+        """Store a fetched document as the newest one of its URL.
+
+        Error pages and other non-2xx responses are not stored.
+        """
+        if not 200 <= response.status < 300:
+            return
+        digest = response.body_hash
+        path = self.path(digest)
+        with self.lock:
+            if not os.path.exists(path):
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                tmp = path + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(zlib.compress(response.body, LEVEL))
+                os.rename(tmp, path)  # Never leave a partial body.
+            now = util.now()
+            d = dict(url=response.url, hash=digest, now=now,
+                     status=response.status, href=response.href,
+                     headers=json.dumps(response.headers),
+                     size=os.path.getsize(path), keep=self.keep)
+            try:
+                with self.conn:
+                    removed = self.add(d)
+            except Exception:
+                self.total = self.total_size()  # Rolled back.
+                raise
+            for digest in removed:
+                try:
+                    os.remove(self.path(digest))
+                except OSError:
+                    pass  # Already gone.
+
+    def add(self, d):
+        """Add response to the index, return hashes of bodies to remove."""
+        if self.conn.execute('SELECT 1 FROM Bodies WHERE hash = :hash',
+                             d).fetchone() is None:
+            self.conn.execute("""
+                INSERT INTO Bodies(hash, size, used)
+                VALUES(:hash, :size, :now)
+                """, d)
+            self.total += d['size']
+        else:
+            self.conn.execute("""
+                UPDATE Bodies SET used = :now WHERE hash = :hash
+                """, d)
+        self.conn.execute("""
+            DELETE FROM Responses WHERE url = :url AND hash = :hash
+            """, d)
+        self.conn.execute("""
+            INSERT INTO Responses(url, hash, fetched, status, headers, href)
+            VALUES(:url, :hash, :now, :status, :headers, :href)
+            """, d)
+        rows = self.conn.execute("""
+            SELECT id, hash FROM Responses WHERE url = :url
+            ORDER BY fetched DESC, id DESC LIMIT -1 OFFSET :keep
+            """, d).fetchall()
+        self.conn.executemany('DELETE FROM Responses WHERE id = ?',
+                              ((row['id'],) for row in rows))
+        return self.evict(set(row['hash'] for row in rows))
+
+    def evict(self, hashes):
+        """Remove least recently used bodies while over the size cap.
+
+        Of the given hashes, whose responses were just dropped, bodies left
+        without any response are removed too. Return the removed hashes.
+        """
+        old = []
+        if self.total > self.max_size:
+            total = self.total
+            cur = self.conn.execute("""
+                SELECT hash, size FROM Bodies ORDER BY used
+                """)  # Oldest first, by index Bodies_used.
+            for row in cur:
+                if total <= self.max_size:
+                    break
+                old.append(row['hash'])
+                total -= row['size']
+            cur.close()
+            self.conn.executemany('DELETE FROM Responses WHERE hash = ?',
+                                  ((h,) for h in old))
+        removed = set(old)
+        for h in hashes - removed:
+            if self.conn.execute('SELECT 1 FROM Responses WHERE hash = ?',
+                                 (h,)).fetchone() is None:
+                removed.add(h)
+        for h in removed:
+            row = self.conn.execute('SELECT size FROM Bodies WHERE hash = ?',
+                                    (h,)).fetchone()
+            self.conn.execute('DELETE FROM Bodies WHERE hash = ?', (h,))
+            self.total -= row['size']
+        return removed
+
+    def latest(self, url):
+        """Return the newest stored 2xx response of URL, or None."""
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT * FROM Responses
+                WHERE url = ? AND status BETWEEN 200 AND 299
+                ORDER BY fetched DESC, id DESC LIMIT 1
+                """, (url,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self.path(row['hash']), 'rb') as f:
+                    body = zlib.decompress(f.read())
+            except (IOError, zlib.error):
+                return None
+            with self.conn:
+                self.conn.execute('UPDATE Bodies SET used = ? WHERE hash = ?',
+                                  (util.now(), row['hash']))
+        headers = dict((str(k), str(v)) for k, v in
+                       json.loads(row['headers']).iteritems())
+        return feed_fetch.Response(row['url'], row['status'], headers, body,
+                                   row['href'], size=len(body))
+
+    def size(self):
+        """Return the number of bodies and their total size in bytes."""
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT COUNT(*), COALESCE(SUM(size), 0) FROM Bodies
+                """).fetchone()
+        return tuple(row)
+
+    def close(self):
+        self.conn.close()
@@ -1,7 +1,11 @@
 """Database API."""
 
 from __future__ import absolute_import, division, print_function
+import json
 import sqlite3
+import time
+from timeit import default_timer as timer
+import zlib
 
 import util
 
@@ -40,37 +44,629 @@ CREATE_DB = """
         FOREIGN KEY(feed_id) REFERENCES Feeds(id)
     );
     """
+CREATE_INDEXES = """
+    CREATE INDEX IF NOT EXISTS Feeds_category ON Feeds(category);
+    CREATE INDEX IF NOT EXISTS Entries_progress
+        ON Entries(progress, feed_id, updated);
+    CREATE INDEX IF NOT EXISTS Entries_feed
+        ON Entries(feed_id, progress, updated);
+    """
+CREATE_COUNTS = """
+    CREATE TABLE IF NOT EXISTS FeedCounts(
+        feed_id INTEGER PRIMARY KEY,
+        n_unread INTEGER NOT NULL DEFAULT 0,
+        n_total INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TRIGGER IF NOT EXISTS Feeds_insert_counts
+    AFTER INSERT ON Feeds
+    BEGIN
+        INSERT INTO FeedCounts(feed_id) VALUES(new.id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS Feeds_delete_counts
+    AFTER DELETE ON Feeds
+    BEGIN
+        DELETE FROM FeedCounts WHERE feed_id = old.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS Entries_insert_counts
+    AFTER INSERT ON Entries
+    BEGIN
+        UPDATE FeedCounts
+        SET n_unread = n_unread + (new.progress = 0), n_total = n_total + 1
+        WHERE feed_id = new.feed_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS Entries_delete_counts
+    AFTER DELETE ON Entries
+    BEGIN
+        UPDATE FeedCounts
+        SET n_unread = n_unread - (old.progress = 0), n_total = n_total - 1
+        WHERE feed_id = old.feed_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS Entries_update_counts
+    AFTER UPDATE OF progress, feed_id ON Entries
+    WHEN (old.progress = 0) IS NOT (new.progress = 0)
+        OR old.feed_id IS NOT new.feed_id
+    BEGIN
+        UPDATE FeedCounts
+        SET n_unread = n_unread - (old.progress = 0), n_total = n_total - 1
+        WHERE feed_id = old.feed_id;
+        UPDATE FeedCounts
+        SET n_unread = n_unread + (new.progress = 0), n_total = n_total + 1
+        WHERE feed_id = new.feed_id;
+    END;
+    """
+CREATE_SEARCH = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS EntrySearch USING fts5(
+        title, summary, content='Entries', content_rowid='id'
+    );
+    CREATE TRIGGER IF NOT EXISTS Entries_insert_search
+    AFTER INSERT ON Entries
+    BEGIN
+        INSERT INTO EntrySearch(rowid, title, summary)
+        VALUES(new.id, new.title, new.summary);
+    END;
+    CREATE TRIGGER IF NOT EXISTS Entries_delete_search
+    AFTER DELETE ON Entries
+    BEGIN
+        INSERT INTO EntrySearch(EntrySearch, rowid, title, summary)
+        VALUES('delete', old.id, old.title, old.summary);
+    END;
+    CREATE TRIGGER IF NOT EXISTS Entries_update_search
+    AFTER UPDATE OF title, summary ON Entries
+    WHEN old.title IS NOT new.title OR old.summary IS NOT new.summary
+    BEGIN
+        INSERT INTO EntrySearch(EntrySearch, rowid, title, summary)
+        VALUES('delete', old.id, old.title, old.summary);
+        INSERT INTO EntrySearch(rowid, title, summary)
+        VALUES(new.id, new.title, new.summary);
+    END;
+    INSERT INTO EntrySearch(EntrySearch) VALUES('rebuild');
+    """
+CREATE_PRUNED = """
+    CREATE TABLE IF NOT EXISTS PrunedEntries(
+        guid TEXT PRIMARY KEY,
+        feed_id INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS PrunedEntries_feed ON PrunedEntries(feed_id);
+    """  # Entries deleted by retention, so that refresh does not restore them.
+CREATE_META = """
+    CREATE TABLE IF NOT EXISTS Meta(
+        name TEXT PRIMARY KEY,
+        value INTEGER
+    );
+    INSERT OR IGNORE INTO Meta(name, value)
+    VALUES('generation', 0), ('modified', CAST(strftime('%s') AS INTEGER));
+    """  # Change generation and time, for validating cached pages.
+CREATE_CONTENT = """
+    CREATE TABLE IF NOT EXISTS EntryContent(
+        entry_id INTEGER PRIMARY KEY
+            REFERENCES Entries(id) ON DELETE CASCADE,
+        description
+    );
+    INSERT INTO EntryContent(entry_id, description)
+    SELECT id, deflate(description) FROM Entries
+    WHERE description IS NOT NULL;
+    """  # Entry descriptions, kept apart from the narrow entry metadata.
+DROP_COLUMN_SQLITE = (3, 35, 0)  # First version with DROP COLUMN.
 DELETE_DB = """
+    DROP TABLE IF EXISTS Meta;
+    DROP TABLE IF EXISTS PrunedEntries;
+    DROP TABLE IF EXISTS EntrySearch;
+    DROP TABLE IF EXISTS FeedCounts;
+    DROP TABLE IF EXISTS EntryContent;
     DROP TABLE IF EXISTS Entries;
     DROP TABLE IF EXISTS Feeds;
     """
-ALTER_DB = """
-    ALTER TABLE Feeds ADD COLUMN etag TEXT;
-    ALTER TABLE Feeds ADD COLUMN modified TEXT;
+FEED_COLUMNS = """
+    Feeds.title AS feed_title, Feeds.link AS feed_link,
+    Feeds.category AS category, Feeds.priority AS priority
+    """  # Feed display fields joined to entries.
+# The description comes first: rows are looked up by the first column of a
+# name, and on old SQLite Entries keeps an emptied column of its own.
+FULL_ENTRIES = """
+    SELECT inflate(EntryContent.description) AS description, Entries.*
+    FROM Entries LEFT JOIN EntryContent
+    ON EntryContent.entry_id = Entries.id
+    """  # Entries with their descriptions, for showing them in full.
+BATCH = 50  # Number of feeds to refresh per transaction.
+CHUNK = 500  # Number of rows to fetch at a time when iterating.
+TIMEOUT = 5  # Seconds to wait for a lock before the database is busy.
+RETRIES = 5  # Number of attempts for a write transaction.
+BACKOFF = 0.1  # Seconds to wait before the first retry, then doubled.
+PRUNE_BATCH = 1000  # Number of entries to prune per transaction.
+VACUUM_PAGES = 1000  # Number of free pages to release per transaction.
+TITLE_WEIGHT = 10.0  # Weight of title matches over summary matches in search.
+COMPRESS_MIN = 256  # Length of description from which it is compressed.
+# Intended scans in frequent queries, as (query name prefix, table): FTS5
+# MATCH lookups show as virtual table scans, and the unfiltered entry totals
+# add up the maintained counts of every feed, one row each.
+PLANNED_SCANS = [
+    ('search(', 'EntrySearch'),
+    ('n_entries(cat=None, feed=None,', 'Feeds'),
+    ]
+
+
+def statements(script):
+    """Split an SQL script into statements."""
+    statement = ''
+    for part in script.split(';')[:-1]:
+        statement += part + ';'
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+
+
+def is_busy(e):
+    """Tell whether an error is due to the database being locked."""
+    msg = str(e)
+    return 'locked' in msg or 'busy' in msg
+
+
+def deflate(text, compress=True):
+    """Return description for storing, as compressed UTF-8 if long."""
+    if text is None or not compress or len(text) < COMPRESS_MIN:
+        return text
+    return buffer(zlib.compress(text.encode('utf-8')))
+
+
+def inflate(value):
+    """Return stored description as text."""
+    if isinstance(value, buffer):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+
+def cat_filter(cat):
+    """Return category filter, exact unless there are LIKE wildcards."""
+    if '%' in cat or '_' in cat:
+        return 'Feeds.category LIKE :cat'
+    return 'Feeds.category = :cat'
+
+
+def feed_filter(cat=None):
+    """Return WHERE clause and parameters for filtering feeds."""
+    if cat:
+        return 'WHERE ' + cat_filter(cat), dict(cat=cat)
+    return '', {}
+
+
+def entry_filter(minprg, maxprg, cat=None, feed=None):
+    """Return WHERE clause and parameters for filtering entries."""
+    clauses = ['progress BETWEEN :minprg AND :maxprg']
+    d = dict(minprg=minprg, maxprg=maxprg)
+    if cat:
+        clauses.append(cat_filter(cat))
+        d['cat'] = cat
+    if feed:
+        clauses.append('feed_id = :feed')
+        d['feed'] = feed
+    return 'WHERE ' + ' AND '.join(clauses), d
+
+
+def n_entries_query(minprg=0, maxprg=0, cat=None, feed=None):
+    """Return query and parameters for counting entries."""
+    where, d = entry_filter(minprg, maxprg, cat, feed)
+    if cat:
+        join = 'INNER JOIN Feeds ON Entries.feed_id = Feeds.id'
+    else:
+        join = ''
+    query = """
+        SELECT COUNT(*)
+        FROM Entries {join}
+        {where}
+        """.format(join=join, where=where)
+    return query, d
+
+
+def n_counted_query(maxprg=0, cat=None, feed=None):
+    """Return query and parameters for counting entries from FeedCounts."""
+    clauses = []
+    d = {}
+    if cat:
+        clauses.append(cat_filter(cat))
+        d['cat'] = cat
+    if feed:
+        clauses.append('Feeds.id = :feed')
+        d['feed'] = feed
+    where = ''
+    if clauses:
+        where = 'WHERE ' + ' AND '.join(clauses)
+    query = """
+        SELECT COALESCE(SUM({column}), 0)
+        FROM FeedCounts INNER JOIN Feeds
+        ON FeedCounts.feed_id = Feeds.id
+        {where}
+        """.format(column=('n_unread', 'n_total')[maxprg], where=where)
+    return query, d
+
+
+def next_query(minprg=0, maxprg=0, cat=None, feed=None, limit=1,
+               priority=True, with_feed=False, after=None, before=None):
+    """Return query and parameters for getting next entries.
+
+    Paging is done by keyset: after and before are the (priority, updated,
+    id) keys of the last or first entry of the current page. With before,
+    the entries come in reverse order.
+    """
+    columns = 'Entries.*'
+    if with_feed:
+        columns += ', ' + FEED_COLUMNS
+    keys = ['Entries.updated', 'Entries.id']
+    if priority:
+        keys.insert(0, 'Feeds.priority')
+    if limit == 0:
+        limit = -1
+    where, d = entry_filter(minprg, maxprg, cat, feed)
+    d['limit'] = limit
+    cursor, direction = after, 'ASC'
+    if before is not None:
+        cursor, direction = before, 'DESC'
+    if cursor is not None:
+        names = ['key_{}'.format(i) for i in range(len(keys))]
+        where += ' AND ({}) {} ({})'.format(
+            ', '.join(keys), '<' if direction == 'DESC' else '>',
+            ', '.join(':' + n for n in names))
+        d.update(zip(names, cursor[-len(keys):]))
+    order = ', '.join('{} {}'.format(k, direction) for k in keys)
+    query = """
+        SELECT {columns}
+        FROM Entries INNER JOIN Feeds
+        ON Entries.feed_id = Feeds.id
+        {where}
+        ORDER BY {order}
+        LIMIT :limit
+        """.format(columns=columns, where=where, order=order)
+    return query, d
+
+
+def progress_query(progress, ids=None, feed=None, cat=None, older=None):
+    """Return statement and parameters for setting progress of entries.
+
+    The entries are selected by an id list, a feed, a category, and an
+    updated time cutoff, whichever are given. Entries that already have the
+    progress are not touched.
+    """
+    clauses = ['progress IS NOT :progress']
+    d = dict(progress=progress)
+    if ids is not None:
+        clauses.append('id IN (SELECT value FROM json_each(:ids))')
+        d['ids'] = json.dumps(list(ids))
+    if feed is not None:
+        clauses.append('feed_id = :feed')
+        d['feed'] = feed
+    if cat is not None:
+        clauses.append('feed_id IN (SELECT id FROM Feeds WHERE {})'.format(
+            cat_filter(cat)))
+        d['cat'] = cat
+    if older is not None:
+        clauses.append('updated < :older')
+        d['older'] = older
+    if len(clauses) == 1:
+        raise ValueError('No entries selected')
+    query = 'UPDATE Entries SET progress = :progress WHERE ' + ' AND '.join(
+        clauses)
+    return query, d
+
+
+def prune_query(feed_id, keep=None, cutoff=None):
+    """Return query and parameters for read entries of a feed to prune.
+
+    The newest keep read entries and those updated at or after cutoff are
+    kept, as are important entries.
     """
+    clauses = ['NOT is_important']
+    d = dict(feed=feed_id, keep=keep or 0)
+    if cutoff is not None:
+        clauses.append('updated < :cutoff')
+        d['cutoff'] = cutoff
+    query = """
+        SELECT id FROM (
+            SELECT id, updated, is_important FROM Entries
+            WHERE feed_id = :feed AND progress = 1
+            ORDER BY updated DESC, id DESC
+            LIMIT -1 OFFSET :keep
+        )
+        WHERE {where}
+        """.format(where=' AND '.join(clauses))
+    return query, d
+
+
+def entry_key(e):
+    """Return the paging key of an entry with its feed fields."""
+    return e['priority'], e['updated'], e['id']
+
+
+def match_expr(text):
+    """Turn free text into an FTS5 query matching all of its words.
+
+    Words are quoted so that operators and stray punctuation do not cause
+    syntax errors. A trailing asterisk makes a word a prefix.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            term = u'"{}"'.format(word.replace('"', '""'))
+            terms.append(term + '*' if prefix else term)
+    return ' '.join(terms)
+
+
+def search_query(text, limit=10, offset=0):
+    """Return query and parameters for searching entries, best first."""
+    d = dict(match=match_expr(text), weight=TITLE_WEIGHT, limit=limit,
+             offset=offset)
+    query = """
+        SELECT Entries.*, {columns}
+        FROM EntrySearch
+        INNER JOIN Entries ON Entries.id = EntrySearch.rowid
+        INNER JOIN Feeds ON Entries.feed_id = Feeds.id
+        WHERE EntrySearch MATCH :match
+        ORDER BY bm25(EntrySearch, :weight, 1.0)
+        LIMIT :limit OFFSET :offset
+        """.format(columns=FEED_COLUMNS)
+    return query, d
+
+
+def hot_queries():
+    """Yield representative (name, query, parameters) of frequent queries."""
+    for maxprg in (0, 1):
+        for cat, feed in ((None, None), ('misc', None), (None, 1)):
+            args = dict(maxprg=maxprg, cat=cat, feed=feed)
+            name = ', '.join('{}={}'.format(k, v) for k, v in
+                             sorted(args.items()))
+            yield ('n_entries({})'.format(name),) + n_counted_query(**args)
+            yield ('get_next({})'.format(name),) + next_query(**args)
+            yield (('get_next({}, after)'.format(name),) +
+                   next_query(after=(0, 0, 0), **args))
+    yield ('search()',) + search_query('word')
+
+
+def add_validators(db):
+    """Add HTTP validator columns to feeds if they are missing."""
+    for name in ('etag', 'modified'):
+        if name not in db.columns('Feeds'):
+            db.cur.execute('ALTER TABLE Feeds ADD COLUMN {} TEXT'.format(name))
+
+
+def add_counts(db):
+    """Add maintained entry counts."""
+    for statement in statements(CREATE_COUNTS):
+        db.cur.execute(statement)
+    db.rebuild_counts()
+
+
+def add_schedule(db):
+    """Add refresh scheduling state to feeds."""
+    db.cur.execute('ALTER TABLE Feeds ADD COLUMN next_due INTEGER')
+    db.cur.execute('ALTER TABLE Feeds ADD COLUMN refresh_interval INTEGER')
+    db.cur.execute("""
+        ALTER TABLE Feeds ADD COLUMN n_errors INTEGER NOT NULL DEFAULT 0
+        """)
+
+
+def add_hashes(db):
+    """Add content hashes for change detection."""
+    db.cur.execute('ALTER TABLE Feeds ADD COLUMN body_hash TEXT')
+    db.cur.execute('ALTER TABLE Entries ADD COLUMN hash TEXT')
+
+
+def add_summaries(db):
+    """Add plaintext summaries, to be filled by backfill_summaries()."""
+    db.cur.execute('ALTER TABLE Feeds ADD COLUMN summary TEXT')
+    db.cur.execute('ALTER TABLE Entries ADD COLUMN summary TEXT')
+
+
+def split_content(db):
+    """Move entry descriptions into EntryContent.
+
+    New databases go through this too: CREATE_DB still has
+    Entries.description, as applied migrations are never changed, so it is
+    created empty and dropped here. SQLite before 3.35 cannot drop it, so
+    there it is only emptied.
+    """
+    for statement in statements(CREATE_CONTENT):
+        db.cur.execute(statement)
+    if sqlite3.sqlite_version_info < DROP_COLUMN_SQLITE:
+        db.cur.execute('UPDATE Entries SET description = NULL')
+    else:
+        db.cur.execute('ALTER TABLE Entries DROP COLUMN description')
+
+
+# Schema migrations, in order. The schema version stored in the database is
+# the number of migrations applied.
+MIGRATIONS = [
+    CREATE_DB,
+    add_validators,
+    CREATE_INDEXES,
+    add_counts,
+    add_schedule,
+    add_hashes,
+    add_summaries,
+    CREATE_SEARCH,
+    CREATE_PRUNED,
+    CREATE_META,
+    split_content,
+    ]
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records statement times and row counts into stats."""
+    stats = None
+    sql = None  # Last executed statement.
+
+    def execute(self, sql, params=()):
+        t = timer()
+        try:
+            return sqlite3.Cursor.execute(self, sql, params)
+        finally:
+            self.record(sql, timer() - t)
+
+    def executemany(self, sql, seq):
+        t = timer()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, seq)
+        finally:
+            self.record(sql, timer() - t)
+
+    def record(self, sql, seconds):
+        self.sql = sql
+        self.stats.query(sql, seconds, max(self.rowcount, 0))
+
+    def fetchone(self):
+        t = timer()
+        row = sqlite3.Cursor.fetchone(self)
+        self.stats.fetched(self.sql, timer() - t, int(row is not None))
+        return row
+
+    def fetchmany(self, *args):
+        t = timer()
+        rows = sqlite3.Cursor.fetchmany(self, *args)
+        self.stats.fetched(self.sql, timer() - t, len(rows))
+        return rows
+
+    def fetchall(self):
+        t = timer()
+        rows = sqlite3.Cursor.fetchall(self)
+        self.stats.fetched(self.sql, timer() - t, len(rows))
+        return rows
 
 
 class FeedDb(object):
-    def __init__(self, filename):
-        self.conn = sqlite3.connect(filename, timeout=5)
+    def __init__(self, filename, timeout=TIMEOUT, stats=None, compress=True):
+        self.stats = stats  # Optional feed_stats.Stats for timings.
+        self.conn = sqlite3.connect(filename, timeout=timeout)
+        # Descriptions are stored through these, see deflate() and inflate().
+        self.conn.create_function('deflate', 1,
+                                  lambda s: deflate(s, compress))
+        self.conn.create_function('inflate', 1, inflate)
         self.conn.execute('PRAGMA foreign_keys=ON')
-        # self.conn.execute('PRAGMA journal_mode=WAL')
+        # Let pruned space be released in steps; only affects new databases.
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # Readers do not block the writer, nor the writer readers.
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
         self.conn.row_factory = sqlite3.Row
+        self.feed_cache = None  # Feeds by id, loaded when first needed.
+        self.data_version = None
+        self.cur = self.cursor()
         self.create_db()
-        self.cur = self.conn.cursor()
+        self.saved_changes = self.conn.total_changes
 
-    def close(self):
+    def cursor(self):
+        """Return a new cursor, timed if collecting stats."""
+        if self.stats is None:
+            return self.conn.cursor()
+        cur = self.conn.cursor(TimedCursor)
+        cur.stats = self.stats
+        return cur
+
+    def commit(self):
+        self.mark_changed()
         self.conn.commit()
+
+    def mark_changed(self):
+        """Bump the change generation if there are changes since last time.
+
+        Called within the transaction before committing.
+        """
+        if self.conn.total_changes != self.saved_changes:
+            self.cur.execute("""
+                UPDATE Meta
+                SET value = CASE name WHEN 'generation' THEN value + 1
+                    ELSE :now END
+                WHERE name IN ('generation', 'modified')
+                """, dict(now=util.now()))
+            self.saved_changes = self.conn.total_changes
+
+    def generation(self):
+        """Return the change generation and the time of the last change."""
+        self.cur.execute("""
+            SELECT name, value FROM Meta
+            WHERE name IN ('generation', 'modified')
+            """)
+        d = dict(self.cur.fetchall())
+        return d['generation'], d['modified']
+
+    def sync(self):
+        """Drop cached data if another connection has changed the database.
+
+        A long-lived connection should call this before handling a request.
+        """
+        self.cur.execute('PRAGMA data_version')
+        data_version = util.sole(self.cur.fetchone())
+        if data_version != self.data_version:
+            self.data_version = data_version
+            self.feed_cache = None
+
+    def write(self, func, *args, **kwargs):
+        """Call func in a transaction, retry with backoff if busy."""
+        def attempt():
+            with self.conn:
+                result = func(*args, **kwargs)
+                self.mark_changed()
+                return result
+
+        delay = BACKOFF
+        for _ in range(RETRIES - 1):
+            try:
+                return attempt()
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise
+            time.sleep(delay)
+            delay *= 2
+        return attempt()
+
+    def close(self):
         total_changes = self.conn.total_changes
+        self.commit()
         self.conn.close()
         return total_changes
 
     def create_db(self):
-        self.conn.executescript(CREATE_DB)
-        # self.conn.executescript(ALTER_DB)
+        """Create or upgrade the schema."""
+        if self.schema_version() < len(MIGRATIONS):
+            self.migrate()
+
+    def schema_version(self):
+        self.cur.execute('PRAGMA user_version')
+        return util.sole(self.cur.fetchone())
+
+    def columns(self, table):
+        """Return column names of table."""
+        self.cur.execute('PRAGMA table_info({})'.format(table))
+        return [row['name'] for row in self.cur.fetchall()]
+
+    def migrate(self):
+        """Apply pending schema migrations in one transaction."""
+        self.conn.commit()
+        isolation_level = self.conn.isolation_level
+        self.conn.isolation_level = None  # Let DDL stay in the transaction.
+        try:
+            self.cur.execute('BEGIN IMMEDIATE')
+            try:
+                # Another connection may have migrated meanwhile.
+                version = self.schema_version()
+                for i in range(version, len(MIGRATIONS)):
+                    migration = MIGRATIONS[i]
+                    if callable(migration):
+                        migration(self)
+                    else:
+                        for statement in statements(migration):
+                            self.cur.execute(statement)
+                    self.cur.execute('PRAGMA user_version={}'.format(i + 1))
+            except BaseException:
+                self.cur.execute('ROLLBACK')
+                raise
+            self.cur.execute('COMMIT')
+        finally:
+            self.conn.isolation_level = isolation_level
 
     def delete_db(self):
         self.conn.executescript(DELETE_DB)
+        self.conn.execute('PRAGMA user_version=0')
+        self.feed_cache = None
+        self.saved_changes = self.conn.total_changes
 
     def insert_feed(self, url, category, priority):
         """Insert feed url."""
@@ -85,6 +681,7 @@ class FeedDb(object):
             SET category=:cat, priority=:pri
             WHERE url=:url
             """, d)
+        self.feed_cache = None
 
     def insert_entry(self, guid, feed_id):
         """Insert entry guid."""
@@ -98,123 +695,512 @@ class FeedDb(object):
         """Update feed."""
         self.cur.execute("""
             UPDATE Feeds
-            SET etag=:etag, modified=:modified,
+            SET etag=:etag, modified=:modified, body_hash=:body_hash,
                 refreshed=:refreshed, updated=:updated,
-                title=:title, description=:description, link=:link
+                title=:title, description=:description, summary=:summary,
+                link=:link
             WHERE url=:url
             """, feed)
+        self.feed_cache = None
 
     def update_entry(self, entry):
         """Update entry."""
         self.cur.execute("""
             UPDATE Entries
             SET refreshed=:refreshed, updated=:updated,
-                title=:title, description=:description, link=:link,
+                title=:title, summary=:summary,
+                link=:link,
             enc_url=:enc_url, enc_length=:enc_length, enc_type=:enc_type
             WHERE guid=:guid
             """, entry)
+        self.upsert_content([entry])
+
+    def upsert_content(self, entries):
+        """Store descriptions of entries that exist."""
+        self.cur.executemany("""
+            INSERT INTO EntryContent(entry_id, description)
+            SELECT id, deflate(:description) FROM Entries WHERE guid = :guid
+            ON CONFLICT(entry_id) DO UPDATE
+            SET description=excluded.description
+            """, entries)
+
+    def upsert_entries(self, feed_id, entries, force=False):
+        """Insert or update a batch of entries.
+
+        Entries whose content hash has not changed are left alone unless
+        force is set, and pruned entries are not restored. Return the number
+        of entries written.
+        """
+        self.cur.execute("""
+            SELECT guid, hash FROM Entries
+            WHERE guid IN (SELECT value FROM json_each(?))
+            """, (json.dumps([e['guid'] for e in entries]),))
+        hashes = dict((r['guid'], r['hash']) for r in self.cur.fetchall())
+        rows = [dict(e, feed_id=feed_id) for e in entries if force or
+                e['guid'] not in hashes or hashes[e['guid']] != e['hash']]
+        if not rows:
+            return 0
+        self.cur.executemany("""
+            INSERT
+            INTO Entries(guid, feed_id, refreshed, updated,
+                title, summary, link, enc_url, enc_length, enc_type, hash)
+            SELECT :guid, :feed_id, :refreshed, :updated,
+                :title, :summary, :link, :enc_url, :enc_length, :enc_type,
+                :hash
+            WHERE NOT EXISTS (SELECT 1 FROM PrunedEntries WHERE guid = :guid)
+            ON CONFLICT(guid) DO UPDATE
+            SET refreshed=excluded.refreshed, updated=excluded.updated,
+                title=excluded.title,
+                summary=excluded.summary, link=excluded.link,
+                enc_url=excluded.enc_url, enc_length=excluded.enc_length,
+                enc_type=excluded.enc_type,
+                hash=excluded.hash
+            """, rows)
+        n = max(self.cur.rowcount, 0)
+        self.upsert_content(rows)
+        return n
+
+    def expire_pruned(self, feed_id, entries):
+        """Forget pruned guids of feed that its document no longer lists.
 
-    def refresh_feed(self, feed_id, feed, entries):
-        """Refresh given feed."""
+        An empty list is more likely a broken document than a feed that
+        dropped everything, so nothing is forgotten then.
+        """
+        if not entries:
+            return
+        self.cur.execute("""
+            DELETE FROM PrunedEntries
+            WHERE feed_id = :feed AND guid NOT IN (
+                SELECT value FROM json_each(:guids))
+            """, dict(feed=feed_id,
+                      guids=json.dumps([e['guid'] for e in entries])))
+
+    def refresh_feed(self, feed_id, feed, entries, force=False):
+        """Refresh given feed, return the number of entries written."""
         self.update_feed(feed)
-        for entry in entries:
-            self.insert_entry(entry['guid'], feed_id)
-            self.update_entry(entry)
+        if not feed.get('bozo'):  # A partial parse may not list them all.
+            self.expire_pruned(feed_id, entries)
+        return self.upsert_entries(feed_id, entries, force=force)
+
+    def refresh_feeds(self, items, batch=BATCH, force=False, schedules=None):
+        """Refresh feeds from (feed_id, feed, entries) tuples.
+
+        Each batch of feeds is written in its own short transaction, so that
+        other connections are not locked out for the whole refresh. A feed
+        of None stands for one that has not changed. With force, unchanged
+        entries are rewritten too. Return the number of entries and the
+        number of entries written.
+
+        Parameter schedules is a list that the producer of items appends
+        schedule_feeds() tuples to; the pending ones are written with each
+        batch, so an interrupted refresh keeps the state of the feeds done.
+        """
+        def write_chunk(chunk, pending):
+            n = 0
+            for feed_id, feed, entries in chunk:
+                if not feed:
+                    continue
+                t = timer()
+                n += self.refresh_feed(feed_id, feed, entries, force=force)
+                if self.stats is not None:
+                    self.stats.feed(feed['url'], write=timer() - t)
+            self.schedule_feeds(pending)
+            return n
+
+        n = n_written = 0
+        items = iter(items)
+        if schedules is None:
+            schedules = []
+        while True:
+            chunk = util.take(batch, items)
+            if not chunk and not schedules:
+                return n, n_written
+            pending = list(schedules)
+            n_written += self.write(write_chunk, chunk, pending)
+            del schedules[:len(pending)]  # Only once committed.
+            n += sum(len(entries) for _, _, entries in chunk)
+
+    def backfill_summaries(self, summarize, batch=CHUNK):
+        """Fill in missing summaries of feeds and entries.
+
+        Parameter summarize is a function from description to summary. Each
+        batch of rows is written in its own transaction. Return the number
+        of feeds and the number of entries updated.
+        """
+        def write_chunk(table, rows):
+            self.cur.executemany("""
+                UPDATE {} SET summary=? WHERE id=?
+                """.format(table), ((summarize(r['description']), r['id'])
+                                    for r in rows))
+
+        queries = [
+            ('Feeds', 'SELECT id, description FROM Feeds'),
+            ('Entries', FULL_ENTRIES),
+            ]
+        counts = []
+        for table, select in queries:
+            n = last = 0
+            while True:
+                self.cur.execute("""
+                    {select}
+                    WHERE summary IS NULL AND {table}.id > ?
+                    ORDER BY {table}.id LIMIT ?
+                    """.format(select=select, table=table), (last, batch))
+                rows = self.cur.fetchall()
+                if not rows:
+                    break
+                self.write(write_chunk, table, rows)
+                n += len(rows)
+                last = rows[-1]['id']
+            counts.append(n)
+        self.feed_cache = None
+        return tuple(counts)
 
     def n_feeds(self, cat=None):
         """Return the number of feeds in the database."""
-        d = dict(notcat=not cat, cat=cat or '%')
-        self.cur.execute("""
-            SELECT COUNT(*) FROM Feeds
-            WHERE (:notcat OR Feeds.category LIKE :cat)
-            """, d)
+        where, d = feed_filter(cat)
+        self.cur.execute('SELECT COUNT(*) FROM Feeds ' + where, d)
         return util.sole(self.cur.fetchone())
 
     def n_entries(self, minprg=0, maxprg=0, cat=None, feed=None):
         """Return the number of entries in the database."""
-        d = dict(minprg=minprg, maxprg=maxprg,
-                 notcat=not cat, cat=cat or '%',
-                 notfeed=not feed, feed=feed)
-        self.cur.execute("""
-            SELECT COUNT(*)
-            FROM Entries INNER JOIN Feeds
-            ON Entries.feed_id = Feeds.id
-            WHERE (progress BETWEEN :minprg AND :maxprg)
-                AND (:notcat OR Feeds.category LIKE :cat)
-                AND (:notfeed OR feed_id = :feed)
-            """, d)
+        if minprg == 0 and maxprg in (0, 1):
+            self.cur.execute(*n_counted_query(maxprg, cat, feed))
+        else:
+            self.cur.execute(*n_entries_query(minprg, maxprg, cat, feed))
         return util.sole(self.cur.fetchone())
 
     def get_feed(self, feed_id):
         """Get given feed."""
-        d = dict(i=feed_id)
-        self.cur.execute('SELECT * FROM Feeds WHERE id=:i', d)
-        return self.cur.fetchone()
+        if self.feed_cache is None:
+            self.cur.execute('SELECT * FROM Feeds')
+            self.feed_cache = dict((r['id'], r) for r in self.cur.fetchall())
+        return self.feed_cache.get(feed_id)
 
     def get_feeds(self, cat=None):
         """Get feeds."""
-        d = dict(notcat=not cat, cat=cat or '%')
+        where, d = feed_filter(cat)
         self.cur.execute("""
             SELECT *
             FROM Feeds
-            WHERE (:notcat OR Feeds.category LIKE :cat)
+            {where}
             ORDER BY id
+            """.format(where=where), d)
+        return self.cur.fetchall()
+
+    def get_due_feeds(self, now):
+        """Get active feeds that are due for refresh, most overdue first."""
+        d = dict(now=now)
+        self.cur.execute("""
+            SELECT *
+            FROM Feeds
+            WHERE is_active AND (next_due IS NULL OR next_due <= :now)
+            ORDER BY next_due
             """, d)
         return self.cur.fetchall()
 
+    def schedule_feeds(self, schedules):
+        """Set refresh scheduling state of feeds.
+
+        The schedules are (feed_id, next_due, refresh_interval, n_errors).
+        """
+        self.cur.executemany("""
+            UPDATE Feeds
+            SET next_due=?, refresh_interval=?, n_errors=?
+            WHERE id=?
+            """, ((d, i, n, feed_id) for feed_id, d, i, n in schedules))
+        self.feed_cache = None
+
+    def iter_feeds(self, cat=None, by_category=False):
+        """Iterate over feeds, fetching them in chunks."""
+        where, d = feed_filter(cat)
+        order = 'category, id' if by_category else 'id'
+        query = 'SELECT * FROM Feeds {where} ORDER BY {order}'.format(
+            where=where, order=order)
+        return self.iter_rows(query, d)
+
+    def iter_rows(self, query, params=()):
+        """Iterate over query result rows, fetching them in chunks.
+
+        A separate cursor is used, so other queries can be run meanwhile,
+        but a commit would reset it.
+        """
+        cur = self.cursor()
+        try:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(CHUNK)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+        finally:
+            cur.close()
+
     def get_entry(self, entry_id):
-        """Get given entry."""
+        """Get given entry with its description."""
         d = dict(i=entry_id)
-        self.cur.execute('SELECT * FROM Entries WHERE id=:i', d)
+        self.cur.execute(FULL_ENTRIES + 'WHERE Entries.id=:i', d)
         return self.cur.fetchone()
 
     def get_entries(self):
-        """Get all entries."""
-        self.cur.execute('SELECT * FROM Entries ORDER BY id')
+        """Get all entries with their descriptions."""
+        self.cur.execute(FULL_ENTRIES + 'ORDER BY Entries.id')
         return self.cur.fetchall()
 
+    def iter_entries(self):
+        """Iterate over all entries, fetching them in chunks."""
+        return self.iter_rows(FULL_ENTRIES + 'ORDER BY Entries.id')
+
+    def get_descriptions(self, entry_ids):
+        """Return descriptions of given entries by entry id.
+
+        Entry lists come without descriptions, so that the queries only
+        read the narrow entry table; this loads them for showing in full.
+        """
+        self.cur.execute("""
+            SELECT entry_id, inflate(description) FROM EntryContent
+            WHERE entry_id IN (SELECT value FROM json_each(?))
+            """, (json.dumps(list(entry_ids)),))
+        return dict(self.cur.fetchall())
+
     def get_categories(self):
         self.cur.execute('SELECT DISTINCT category FROM Feeds')
         rows = self.cur.fetchall()
         return sorted(util.sole(r) for r in rows)
 
+    def category_stats(self):
+        """Return feed, unread entry, and total entry counts per category."""
+        self.cur.execute("""
+            SELECT category,
+                COUNT(*) AS n_feeds,
+                COALESCE(SUM(n_unread), 0) AS n_unread,
+                COALESCE(SUM(n_total), 0) AS n_total
+            FROM Feeds LEFT JOIN FeedCounts
+            ON FeedCounts.feed_id = Feeds.id
+            GROUP BY category
+            ORDER BY category
+            """)
+        return self.cur.fetchall()
+
+    def feed_stats(self, cat=None):
+        """Get feeds with their unread entry and total entry counts."""
+        where, d = feed_filter(cat)
+        self.cur.execute("""
+            SELECT Feeds.*,
+                COALESCE(n_unread, 0) AS n_unread,
+                COALESCE(n_total, 0) AS n_total
+            FROM Feeds LEFT JOIN FeedCounts
+            ON FeedCounts.feed_id = Feeds.id
+            {where}
+            ORDER BY Feeds.id
+            """.format(where=where), d)
+        return self.cur.fetchall()
+
+    def check_counts(self):
+        """Return (feed_id, stored, actual) for feeds with wrong counts.
+
+        The counts are given as (unread, total) pairs.
+        """
+        self.cur.execute("""
+            SELECT Feeds.id AS feed_id,
+                FeedCounts.n_unread AS n_unread,
+                FeedCounts.n_total AS n_total,
+                (SELECT COUNT(*) FROM Entries
+                 WHERE feed_id = Feeds.id AND progress = 0) AS a_unread,
+                (SELECT COUNT(*) FROM Entries
+                 WHERE feed_id = Feeds.id) AS a_total
+            FROM Feeds LEFT JOIN FeedCounts
+            ON FeedCounts.feed_id = Feeds.id
+            WHERE n_unread IS NOT a_unread OR n_total IS NOT a_total
+            """)
+        return [(r['feed_id'], (r['n_unread'], r['n_total']),
+                 (r['a_unread'], r['a_total'])) for r in self.cur.fetchall()]
+
+    def rebuild_counts(self):
+        """Recompute the maintained entry counts of all feeds."""
+        self.cur.execute('DELETE FROM FeedCounts')
+        self.cur.execute("""
+            INSERT INTO FeedCounts(feed_id, n_unread, n_total)
+            SELECT Feeds.id,
+                COALESCE(SUM(Entries.progress = 0), 0),
+                COUNT(Entries.id)
+            FROM Feeds LEFT JOIN Entries
+            ON Entries.feed_id = Feeds.id
+            GROUP BY Feeds.id
+            """)
+
     def add_feed(self, url, category, priority):
         """Add feed."""
         self.insert_feed(url, category, priority)
 
+    def import_feeds(self, subscriptions, batch=CHUNK):
+        """Add or update feeds from a sequence of (category, priority, url).
+
+        All of them are written in one transaction, in batched statements.
+        Return the number of feeds that were new.
+        """
+        def write_all():
+            n = self.n_feeds()
+            it = iter(subscriptions)
+            while True:
+                chunk = util.take(batch, it)
+                if not chunk:
+                    return self.n_feeds() - n
+                self.cur.executemany("""
+                    INSERT INTO Feeds(category, priority, url)
+                    VALUES(?, ?, ?)
+                    ON CONFLICT(url) DO UPDATE
+                    SET category=excluded.category,
+                        priority=excluded.priority
+                    """, chunk)
+
+        n = self.write(write_all)
+        self.feed_cache = None
+        return n
+
     def remove_feed(self, feed_id):
         """Remove given feed and all its entries."""
         d = dict(i=feed_id)
         self.cur.execute('DELETE FROM Entries WHERE feed_id=:i', d)
+        self.cur.execute('DELETE FROM PrunedEntries WHERE feed_id=:i', d)
         self.cur.execute('DELETE FROM Feeds WHERE id=:i', d)
+        self.feed_cache = None
 
     def get_next(self, minprg=0, maxprg=0, cat=None, feed=None, limit=1,
-                 priority=True):
-        """Get next entry or entries."""
-        if priority:
-            order = 'priority, updated'
-        else:
-            order = 'updated'
-        if limit == 0:
-            limit = -1
-        d = dict(minprg=minprg, maxprg=maxprg,
-                 notcat=not cat, cat=cat or '%',
-                 notfeed=not feed, feed=feed,
-                 limit=limit)
-        query = """
-            SELECT Entries.*
-            FROM Entries INNER JOIN Feeds
-            ON Entries.feed_id = Feeds.id
-            WHERE (progress BETWEEN :minprg AND :maxprg)
-                AND (:notcat OR Feeds.category LIKE :cat)
-                AND (:notfeed OR feed_id = :feed)
-            ORDER BY {order}
-            LIMIT :limit
-            """.format(order=order)
-        self.cur.execute(query, d)
+                 priority=True, with_feed=False, after=None, before=None):
+        """Get next entry or entries.
+
+        With with_feed, the entries include the display fields of their
+        feeds as feed_title, feed_link, category, and priority. Parameters
+        after and before take a key given by entry_key() for paging.
+        """
+        self.cur.execute(*next_query(minprg, maxprg, cat, feed, limit,
+                                     priority, with_feed, after, before))
+        rows = self.cur.fetchall()
+        if before is not None:
+            rows.reverse()
+        return rows
+
+    def search(self, text, limit=10, offset=0):
+        """Get entries matching text, ranked by relevance.
+
+        The entries include the display fields of their feeds.
+        """
+        if not match_expr(text):
+            return []
+        self.cur.execute(*search_query(text, limit, offset))
         return self.cur.fetchall()
 
+    def n_matches(self, text):
+        """Return the number of entries matching text."""
+        match = match_expr(text)
+        if not match:
+            return 0
+        self.cur.execute("""
+            SELECT COUNT(*) FROM EntrySearch WHERE EntrySearch MATCH ?
+            """, (match,))
+        return util.sole(self.cur.fetchone())
+
+    def prune(self, keep=None, days=None, batch=PRUNE_BATCH):
+        """Delete old read entries, return the number of entries deleted.
+
+        Keep the newest keep read entries of each feed, or read entries
+        younger than days, or both; important and unread entries are never
+        deleted. The guids of deleted entries are remembered so that a
+        refresh does not bring them back, until the feed document no longer
+        lists them. Each batch is deleted in its own transaction.
+        """
+        if keep is None and days is None:
+            raise ValueError('No retention given')
+        cutoff = None
+        if days is not None:
+            cutoff = util.now() - int(days * 24 * 60 * 60)
+
+        def delete_chunk(ids):
+            d = dict(ids=json.dumps(ids))
+            self.cur.execute("""
+                INSERT OR IGNORE INTO PrunedEntries(guid, feed_id)
+                SELECT guid, feed_id FROM Entries
+                WHERE id IN (SELECT value FROM json_each(:ids))
+                """, d)
+            self.cur.execute("""
+                DELETE FROM Entries
+                WHERE id IN (SELECT value FROM json_each(:ids))
+                """, d)
+
+        n = 0
+        ids = []
+        for feed_id in [f['id'] for f in self.get_feeds()]:
+            self.cur.execute(*prune_query(feed_id, keep, cutoff))
+            ids.extend(util.sole(r) for r in self.cur.fetchall())
+            while len(ids) >= batch:
+                self.write(delete_chunk, ids[:batch])
+                n += len(ids[:batch])
+                ids = ids[batch:]
+        if ids:
+            self.write(delete_chunk, ids)
+            n += len(ids)
+        return n
+
+    def vacuum(self, pages=VACUUM_PAGES, full=False):
+        """Release free pages to shrink the file, return how many.
+
+        Pages are released a bounded number at a time, each step in its own
+        short transaction. A database created without incremental
+        auto-vacuum is converted with one full VACUUM first. With full, the
+        file is rebuilt anyway, which also packs partly empty pages, such as
+        those left behind by moving descriptions out of Entries.
+        """
+        self.conn.commit()
+        self.cur.execute('PRAGMA auto_vacuum')
+        if full or util.sole(self.cur.fetchone()) != 2:
+            self.cur.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.cur.execute('VACUUM')
+        n = 0
+        while True:
+            self.cur.execute('PRAGMA freelist_count')
+            free = util.sole(self.cur.fetchone())
+            if not free:
+                break
+            # Each step of the statement releases one page.
+            self.cur.execute('PRAGMA incremental_vacuum({})'.format(pages))
+            self.cur.fetchall()
+            n += min(free, pages)
+        self.cur.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return n
+
+    def explain(self, query, params):
+        """Return the query plan details."""
+        self.cur.execute('EXPLAIN QUERY PLAN ' + query, params)
+        return [row['detail'] for row in self.cur.fetchall()]
+
+    def full_scans(self):
+        """Return (name, detail) of unplanned table scans in frequent queries.
+
+        Scans through an index count too, as they still read every row.
+        """
+        scans = []
+        for name, query, params in hot_queries():
+            for detail in self.explain(query, params):
+                words = detail.split()
+                if words[0] != 'SCAN':
+                    continue
+                if not any(name.startswith(prefix) and words[1] == table
+                           for prefix, table in PLANNED_SCANS):
+                    scans.append((name, detail))
+        return scans
+
     def set_progress(self, entry_id, progress):
         """Set progress of given entry."""
         d = dict(p=progress, i=entry_id)
         self.cur.execute('UPDATE Entries SET progress=:p WHERE id=:i', d)
+
+    def mark_progress(self, progress, ids=None, feed=None, cat=None,
+                      older=None):
+        """Set progress of selected entries, return how many changed.
+
+        See progress_query() for the selection.
+        """
+        self.cur.execute(*progress_query(progress, ids, feed, cat, older))
+        return self.cur.rowcount
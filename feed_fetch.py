@@ -0,0 +1,203 @@
+"""Concurrent fetching of feed documents over HTTP."""
+
+from __future__ import absolute_import, division, print_function
+from collections import defaultdict, deque, OrderedDict
+import hashlib
+import httplib
+import Queue
+import socket
+import threading
+from timeit import default_timer as timer
+import urlparse
+import zlib
+
+USER_AGENT = 'feed-reader (+https://github.com/jupito/feed-reader)'
+ACCEPT = ('application/atom+xml,application/rdf+xml,application/rss+xml,'
+          'application/xml;q=0.9,text/xml;q=0.8,*/*;q=0.1')
+MAX_REDIRECTS = 5
+JOBS = 16  # Default global concurrency limit.
+PER_HOST = 2  # Default per-host concurrency limit.
+TIMEOUT = 30  # Default socket timeout in seconds.
+SCHEMES = ('http', 'https')  # URL schemes fetched here.
+
+
+class Response(object):
+    """Fetched feed document."""
+    def __init__(self, url, status, headers, body, href, size=None,
+                 elapsed=None):
+        self.url = url  # Requested URL.
+        self.status = status
+        self.headers = headers  # Dictionary with lowercase names.
+        self.body = body
+        self.href = href  # Final URL after redirections.
+        self.body_hash = hashlib.sha1(body).hexdigest()
+        self.size = size  # Bytes transferred, before decoding.
+        self.elapsed = elapsed  # Seconds taken, with redirections.
+
+
+class HostPool(object):
+    """Keep-alive HTTP connections with a concurrency limit per host."""
+    def __init__(self, per_host=PER_HOST, timeout=TIMEOUT):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.slots = {}
+
+    def slot(self, key):
+        """Return the semaphore limiting connections to host."""
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.per_host)
+            return self.slots[key]
+
+    def connect(self, key):
+        """Return an idle connection to host, or a new one."""
+        with self.lock:
+            if self.idle[key]:
+                return self.idle[key].pop(), True
+        scheme, netloc = key
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        return cls(netloc, timeout=self.timeout), False
+
+    def release(self, key, conn):
+        """Return connection to the idle set."""
+        with self.lock:
+            self.idle[key].append(conn)
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+    def get(self, url, headers):
+        """Do a GET request, return status, headers, and body."""
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in SCHEMES:
+            raise IOError(-1, 'Unsupported URL scheme', url)
+        key = parts.scheme, parts.netloc
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query,
+                                    ''))
+        with self.slot(key):
+            while True:
+                conn, reused = self.connect(key)
+                try:
+                    conn.request('GET', path, headers=headers)
+                    resp = conn.getresponse()
+                    body = resp.read()
+                except (httplib.HTTPException, socket.error) as e:
+                    conn.close()
+                    if reused:
+                        continue  # Server closed a kept-alive connection.
+                    raise IOError(-1, 'Connection error: {}'.format(e), url)
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self.release(key, conn)
+                return resp.status, dict(resp.getheaders()), body
+
+
+def is_fetchable(url):
+    """Tell whether URL can be fetched here, rather than by feedparser."""
+    return urlparse.urlsplit(url).scheme in SCHEMES
+
+
+def decode_body(headers, body):
+    """Undo content encoding."""
+    encoding = headers.get('content-encoding', '').lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+def fetch(pool, url, etag=None, modified=None):
+    """Fetch a feed document, following redirections."""
+    headers = {
+        'User-Agent': USER_AGENT,
+        'Accept': ACCEPT,
+        'Accept-Encoding': 'gzip, deflate',
+        }
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    href = url
+    t = timer()
+    size = 0
+    for _ in range(MAX_REDIRECTS + 1):
+        status, resp_headers, body = pool.get(href, headers)
+        size += len(body)
+        if status in (301, 302, 303, 307, 308) and 'location' in resp_headers:
+            href = urlparse.urljoin(href, resp_headers['location'])
+            continue
+        try:
+            body = decode_body(resp_headers, body)
+        except zlib.error as e:
+            raise IOError(-1, 'Content decoding error: {}'.format(e), url)
+        resp_headers.pop('content-encoding', None)
+        return Response(url, status, resp_headers, body, href, size=size,
+                        elapsed=timer() - t)
+    raise IOError(-1, 'Too many redirections', url)
+
+
+def interleave_hosts(feeds):
+    """Order feeds round-robin by host, so workers do not queue on one."""
+    hosts = OrderedDict()
+    for f in feeds:
+        host = urlparse.urlsplit(f['url']).netloc
+        hosts.setdefault(host, deque()).append(f)
+    queues = deque(hosts.values())
+    while queues:
+        q = queues.popleft()
+        yield q.popleft()
+        if q:
+            queues.append(q)
+
+
+def fetch_all(feeds, jobs=JOBS, per_host=PER_HOST, timeout=TIMEOUT):
+    """Fetch feeds concurrently, yield (feed, response, error) as completed.
+
+    The stored etag and modified values are sent with the requests; an
+    unchanged document yields a response with status 304.
+    """
+    feeds = list(interleave_hosts(feeds))
+    todo = Queue.Queue()
+    done = Queue.Queue()
+    for f in feeds:
+        todo.put(f)
+    pool = HostPool(per_host=per_host, timeout=timeout)
+
+    def work():
+        while True:
+            try:
+                f = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                r = fetch(pool, f['url'], etag=f['etag'],
+                          modified=f['modified'])
+            except Exception as e:  # Every feed must yield a result.
+                done.put((f, None, e))
+            else:
+                done.put((f, r, None))
+
+    for _ in range(min(jobs, len(feeds))):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+    try:
+        for _ in feeds:
+            yield done.get()
+    finally:
+        pool.close()
@@ -0,0 +1,103 @@
+"""Importing and exporting subscription lists as CSV or OPML.
+
+Subscriptions are (category, priority, url) tuples, as in feed_tool --add.
+Input is parsed incrementally and output is written as it is generated, so
+that big lists need not be held in memory as a document.
+"""
+
+from __future__ import absolute_import, division, print_function
+from collections import OrderedDict
+import csv
+from itertools import groupby
+from operator import itemgetter
+from xml.etree import cElementTree as ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+import util
+
+CATEGORY = 'misc'  # Default category, as in the database.
+
+
+def is_opml(filename):
+    return filename.lower().endswith(('.opml', '.xml'))
+
+
+def read_csv(f):
+    """Yield subscriptions from CSV rows (category,priority,url)."""
+    for n, row in enumerate(csv.reader(f), 1):
+        if not row:
+            continue
+        try:
+            category, priority, url = [util.utf8(x).strip() for x in row]
+            yield category, int(priority), url
+        except ValueError:
+            raise ValueError('Invalid CSV row {}: {}'.format(n, row))
+
+
+def read_opml(f, category=CATEGORY, priority=0):
+    """Yield subscriptions from OPML outlines.
+
+    The category of a feed is the title of its enclosing outline, or the
+    given one if it is not in a folder. Outline attribute priority is
+    honored if present.
+    """
+    folders = []
+    for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+        if elem.tag != 'outline':
+            continue
+        url = elem.get('xmlUrl')
+        if event == 'start':
+            if url is None:
+                folders.append(elem.get('title') or elem.get('text'))
+            continue
+        if url is None:
+            folders.pop()
+        else:
+            cat = next((x for x in reversed(folders) if x), category)
+            try:
+                pri = int(elem.get('priority', priority))
+            except ValueError:
+                pri = priority
+            yield unicode(cat), pri, unicode(url.strip())
+        elem.clear()
+
+
+def unique(subscriptions):
+    """Return subscriptions by URL, a later one overriding an earlier."""
+    d = OrderedDict()
+    for category, priority, url in subscriptions:
+        d[url] = category, priority, url
+    return d.values()
+
+
+def write_csv(f, feeds):
+    """Write feed rows to a binary file as CSV."""
+    w = csv.writer(f)
+    for feed in feeds:
+        w.writerow([feed['category'].encode('utf-8'), feed['priority'],
+                    feed['url'].encode('utf-8')])
+
+
+def write_opml(f, feeds, title='Subscriptions'):
+    """Write feed rows ordered by category to a binary file as OPML."""
+    def lines():
+        yield '<?xml version="1.0" encoding="utf-8"?>\n'
+        yield '<opml version="2.0">\n'
+        yield u'<head><title>{}</title></head>\n'.format(escape(title))
+        yield '<body>\n'
+        for category, group in groupby(feeds, itemgetter('category')):
+            yield u'<outline text={c} title={c}>\n'.format(
+                c=quoteattr(category))
+            for feed in group:
+                yield (u'<outline type="rss" text={t} title={t} xmlUrl={u}'
+                       ' htmlUrl={l} priority="{p}"/>\n').format(
+                           t=quoteattr(feed['title'] or feed['url']),
+                           u=quoteattr(feed['url']),
+                           l=quoteattr(feed['link'] or ''),
+                           p=feed['priority'])
+            yield '</outline>\n'
+        yield '</body>\n'
+        yield '</opml>\n'
+
+    for s in lines():
+        f.write(s.encode('utf-8'))
@@ -0,0 +1,167 @@
+"""Staged refresh pipeline: fetching, parsing, and writing feeds.
+
+Feeds are fetched concurrently by threads, the fetched documents are parsed
+in a pool of worker processes, and the results are handed through a bounded
+queue to the caller, which is the single database writer.
+"""
+
+from __future__ import absolute_import, division, print_function
+import multiprocessing
+import Queue
+import threading
+from timeit import default_timer as timer
+
+import feed_fetch
+import feed_util
+
+QUEUE_SIZE = 64  # Maximum number of documents in flight after fetching.
+
+
+def is_unchanged(f, response):
+    """Tell whether a fetched document is the same as last time."""
+    return response.status == 304 or response.body_hash == f['body_hash']
+
+
+def fetch_timings(response):
+    """Return fetch timings of a response for Stats.feed()."""
+    return dict(fetch=response.elapsed, bytes=response.size)
+
+
+def store(cache, response, debug=None):
+    """Store a document into cache; failing that does not fail a refresh."""
+    try:
+        cache.store(response)
+    except Exception as e:  # Disk full, index locked, and such.
+        if debug:
+            debug('Cannot cache {}: {}'.format(response.url, e))
+
+
+def fetch_parse(pool, f, timings, debug=None, cache=None):
+    """Fetch and parse a feed, record timings into the given dictionary."""
+    if not feed_fetch.is_fetchable(f['url']):
+        # Let feedparser open file: and other such URLs itself.
+        t = timer()
+        result = feed_util.parse_url(f['url'], f['etag'], f['modified'],
+                                     debug=debug)
+        timings['parse'] = timer() - t
+        return result
+    response = feed_fetch.fetch(pool, f['url'], etag=f['etag'],
+                                modified=f['modified'])
+    timings.update(fetch_timings(response))
+    if is_unchanged(f, response):
+        return False, False
+    if cache is not None:
+        store(cache, response, debug)
+    t = timer()
+    result = feed_util.parse_response(response, debug=debug)
+    timings['parse'] = timer() - t
+    return result
+
+
+def sequential(feeds, debug=None, stats=None, cache=None):
+    """Fetch and parse feeds one by one, yield (feed, result, error).
+
+    With stats, per-feed timings are recorded into it. With cache, changed
+    documents are stored into it.
+    """
+    pool = feed_fetch.HostPool()
+    try:
+        for f in feeds:
+            timings = {}
+            try:
+                result = fetch_parse(pool, f, timings, debug, cache)
+            except Exception as e:  # A broken feed must not stop the rest.
+                if stats is not None:
+                    stats.feed(f['url'], errors=1, **timings)
+                yield f, None, e
+            else:
+                if stats is not None:
+                    stats.feed(f['url'], **timings)
+                yield f, result, None
+    finally:
+        pool.close()
+
+
+def parse_job(job):
+    """Parse a fetched document in a worker process.
+
+    The document is either a response or, for URLs that are not fetched
+    here, a (url, etag, modified) tuple for feedparser to fetch.
+    """
+    feed_id, response, messages = job
+    t = timer()
+    try:
+        if isinstance(response, tuple):
+            timings = {}
+            url, etag, modified = response
+            result = feed_util.parse_url(url, etag, modified,
+                                         debug=messages.append)
+        else:
+            timings = fetch_timings(response)
+            result = feed_util.parse_response(response, debug=messages.append)
+    except Exception as e:  # Every job must put a result, or pipeline hangs.
+        if not isinstance(e, (IOError, ValueError)):
+            # Report bugs in parsing as a plain error that surely pickles.
+            e = ValueError('{}: {}'.format(type(e).__name__, e))
+        timings.update(parse=timer() - t, errors=1)
+        return feed_id, None, e, messages, timings
+    timings['parse'] = timer() - t
+    return feed_id, result, None, messages, timings
+
+
+def pipeline(feeds, jobs=feed_fetch.JOBS, per_host=feed_fetch.PER_HOST,
+             procs=None, queue_size=QUEUE_SIZE, debug=None, stats=None,
+             cache=None):
+    """Fetch and parse feeds, yield (feed, result, error) as completed.
+
+    The result is a (feed, entries) pair as returned by parse_url(). The
+    caller consumes the results in its own thread, so it can write them to
+    the database without contention. With stats, per-feed timings are
+    recorded into it. With cache, changed documents are stored into it by
+    the fetching thread.
+    """
+    feeds = list(feeds)
+    by_id = dict((f['id'], f) for f in feeds)
+    results = Queue.Queue(maxsize=queue_size)
+    inflight = threading.BoundedSemaphore(queue_size)
+    pool = multiprocessing.Pool(procs)
+
+    def fetch_stage():
+        for f in feeds:
+            if not feed_fetch.is_fetchable(f['url']):
+                inflight.acquire()
+                job = f['id'], (f['url'], f['etag'], f['modified']), []
+                pool.apply_async(parse_job, [job], callback=results.put)
+        responses = feed_fetch.fetch_all(
+            (f for f in feeds if feed_fetch.is_fetchable(f['url'])),
+            jobs=jobs, per_host=per_host)
+        for f, response, error in responses:
+            inflight.acquire()
+            if error is not None:
+                results.put((f['id'], None, error, [], dict(errors=1)))
+            elif is_unchanged(f, response):
+                results.put((f['id'], (False, False), None, [],
+                             fetch_timings(response)))
+            else:
+                messages = []
+                if cache is not None:
+                    store(cache, response, messages.append)
+                pool.apply_async(parse_job, [(f['id'], response, messages)],
+                                 callback=results.put)
+
+    fetcher = threading.Thread(target=fetch_stage)
+    fetcher.daemon = True
+    fetcher.start()
+    try:
+        for _ in feeds:
+            feed_id, result, error, messages, timings = results.get()
+            inflight.release()
+            if debug:
+                for msg in messages:
+                    debug(msg)
+            if stats is not None:
+                stats.feed(by_id[feed_id]['url'], **timings)
+            yield by_id[feed_id], result, error
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,69 @@
+"""Scheduling feed refreshes."""
+
+from __future__ import absolute_import, division, print_function
+from email.utils import mktime_tz, parsedate_tz
+
+MIN_INTERVAL = 60 * 60  # Shortest refresh interval in seconds.
+MAX_INTERVAL = 7 * 24 * 60 * 60  # Longest refresh interval in seconds.
+DEFAULT_INTERVAL = 24 * 60 * 60  # Interval when nothing has been learned.
+MAX_BACKOFF = 30 * 24 * 60 * 60  # Longest wait after repeated errors.
+HISTORY = 20  # Number of newest entries to learn the interval from.
+
+
+def clamp(x, lo, hi):
+    return max(lo, min(x, hi))
+
+
+def learn_interval(times, now):
+    """Estimate refresh interval from entry update times.
+
+    The interval is the median gap between the newest entries, but at least
+    half the time since the newest one, so that dead feeds slow down.
+    """
+    times = sorted(set(t for t in times if t > 0), reverse=True)[:HISTORY]
+    gaps = sorted(a - b for a, b in zip(times, times[1:]))
+    if not gaps:
+        return None
+    interval = max(gaps[len(gaps) // 2], (now - times[0]) // 2)
+    return clamp(interval, MIN_INTERVAL, MAX_INTERVAL)
+
+
+def cache_hint(headers, ttl=None):
+    """Return the time in seconds the server wants a document cached.
+
+    Look at Cache-Control and Expires headers, and RSS ttl in minutes.
+    """
+    hints = []
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() in ('max-age', 's-maxage') and value.isdigit():
+            hints.append(int(value))
+    if not hints and 'expires' in headers:
+        expires = parsedate_tz(headers['expires'])
+        date = parsedate_tz(headers.get('date', ''))
+        if expires and date:
+            hints.append(mktime_tz(expires) - mktime_tz(date))
+    if ttl and unicode(ttl).isdigit():
+        hints.append(int(ttl) * 60)
+    return min(max(hints or [0]), MAX_INTERVAL)
+
+
+def schedule(f, result, error, now):
+    """Return (next_due, refresh_interval, n_errors) for a refresh result.
+
+    Parameter f is the feed row, result and error are as given by the
+    refresh pipeline.
+    """
+    interval = f['refresh_interval'] or DEFAULT_INTERVAL
+    if error is not None:
+        n_errors = f['n_errors'] + 1
+        backoff = min(interval * 2 ** n_errors, MAX_BACKOFF)
+        return now + backoff, interval, n_errors
+    feed, entries = result
+    if feed:
+        times = [e['updated'] for e in entries]
+        interval = learn_interval(times, now) or interval
+        wait = max(interval, feed.get('max_age') or 0)
+    else:
+        wait = interval  # Not modified.
+    return now + wait, interval, 0
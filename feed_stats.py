@@ -0,0 +1,67 @@
+"""Collecting statement and refresh timings."""
+
+from __future__ import absolute_import, division, print_function
+from collections import defaultdict
+import sys
+
+FEED_FIELDS = ('fetch', 'parse', 'write', 'bytes', 'errors')
+
+
+def statement_key(sql):
+    """Return statement with whitespace normalized, for grouping."""
+    return ' '.join(sql.split())
+
+
+def log_stderr(msg):
+    print(msg, file=sys.stderr)
+
+
+class Stats(object):
+    """Statement times and row counts, and per-feed refresh timings.
+
+    Statements taking at least slow seconds are passed to log.
+    """
+    def __init__(self, slow=None, log=log_stderr):
+        self.slow = slow
+        self.log = log
+        self.queries = defaultdict(lambda: dict(n=0, seconds=0.0, max=0.0,
+                                                rows=0))
+        self.feeds = defaultdict(lambda: dict.fromkeys(FEED_FIELDS, 0))
+
+    def query(self, sql, seconds, rows=0):
+        """Record statement execution."""
+        d = self.queries[statement_key(sql)]
+        d['n'] += 1
+        d['seconds'] += seconds
+        d['max'] = max(d['max'], seconds)
+        d['rows'] += rows
+        if self.slow is not None and seconds >= self.slow:
+            self.log('Slow statement ({:.1f} ms): {}'.format(
+                seconds * 1000, statement_key(sql)))
+
+    def fetched(self, sql, seconds, rows):
+        """Record fetching result rows of statement."""
+        d = self.queries[statement_key(sql)]
+        d['seconds'] += seconds
+        d['rows'] += rows
+
+    def feed(self, url, **kwargs):
+        """Add to timings of feed, given as seconds or byte counts."""
+        d = self.feeds[url]
+        for k, v in kwargs.iteritems():
+            d[k] += v or 0
+
+    def summary(self):
+        """Return collected statistics as a dictionary for JSON."""
+        queries = [dict(d, sql=sql) for sql, d in self.queries.iteritems()]
+        queries.sort(key=lambda d: d['seconds'], reverse=True)
+        feeds = [dict(d, url=url) for url, d in self.feeds.iteritems()]
+        feeds.sort(key=lambda d: d['fetch'] + d['parse'] + d['write'],
+                   reverse=True)
+        totals = dict((k, sum(d[k] for d in feeds)) for k in FEED_FIELDS)
+        totals.update(
+            statements=sum(d['n'] for d in queries),
+            statement_seconds=sum(d['seconds'] for d in queries),
+            feeds=len(feeds),
+            )
+        return dict(totals=totals, queries=queries, feeds=feeds)
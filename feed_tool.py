@@ -4,9 +4,16 @@
 
 from __future__ import absolute_import, division, print_function
 import argparse
-import csv
+import json
+import sys
 
+import feed_cache
 import feed_db
+import feed_fetch
+import feed_io
+import feed_refresh
+import feed_schedule
+import feed_stats
 import feed_util
 import util
 
@@ -19,6 +26,10 @@ def parse_args():
                    help='add feeds from strings (category,priority,url)')
     p.add_argument('--addcsv', nargs='+', metavar='CSV_FILE',
                    help='add feeds from CSV file (category,priority,url)')
+    p.add_argument('--import', nargs='+', metavar='FILE', dest='imports',
+                   help='add or update feeds from CSV or OPML files at once')
+    p.add_argument('--export', metavar='FILE',
+                   help='write feeds to CSV or OPML file (- for CSV output)')
     p.add_argument('--remove', nargs='+', metavar='FEED_ID', type=int,
                    help='remove feeds')
     p.add_argument('--category',
@@ -27,6 +38,25 @@ def parse_args():
                    help='priority')
     p.add_argument('--refresh', nargs='*', metavar='FEED_ID', type=int,
                    help='refresh feeds')
+    p.add_argument('--due', action='store_true',
+                   help='refresh only feeds that are due')
+    p.add_argument('--jobs', '-j', type=int, default=1,
+                   help='number of concurrent fetches when refreshing')
+    p.add_argument('--per-host', type=int, default=feed_fetch.PER_HOST,
+                   help='number of concurrent fetches per host')
+    p.add_argument('--procs', type=int,
+                   help='number of parser processes (default: CPU count)')
+    p.add_argument('--batch', type=int, default=feed_db.BATCH,
+                   help='number of feeds to write per transaction')
+    p.add_argument('--cache', metavar='DIR',
+                   help='keep fetched documents in this directory')
+    p.add_argument('--cache-keep', type=int, default=feed_cache.KEEP,
+                   metavar='N', help='number of documents to keep per feed')
+    p.add_argument('--cache-size', type=float, metavar='MB',
+                   default=feed_cache.MAX_SIZE / 1024 / 1024,
+                   help='maximum size of cached documents')
+    p.add_argument('--reingest', nargs='*', metavar='FEED_ID', type=int,
+                   help='parse feeds again from cached documents (or all)')
     p.add_argument('--feeds', '-f', nargs='*', metavar='FEED_ID', type=int,
                    help='list feeds')
     p.add_argument('--entries', '-e', nargs='*', metavar='ENTRY_ID', type=int,
@@ -35,6 +65,43 @@ def parse_args():
                    help='list categories')
     p.add_argument('--get', action='store_true',
                    help='show next unread')
+    p.add_argument('--markread', nargs='*', metavar='ENTRY_ID', type=int,
+                   help='mark entries read, selected by id or by --category, '
+                   '--feed-id, and --older-than')
+    p.add_argument('--markunread', nargs='*', metavar='ENTRY_ID', type=int,
+                   help='mark entries unread, selected like with --markread')
+    p.add_argument('--feed-id', type=int,
+                   help='feed to mark')
+    p.add_argument('--older-than', type=float, metavar='DAYS',
+                   help='mark only entries updated before this many days ago')
+    p.add_argument('--prune', action='store_true',
+                   help='delete old read entries, keeping those given by '
+                   '--keep and --keep-days, and important ones')
+    p.add_argument('--keep', type=int, metavar='N',
+                   help='number of newest read entries to keep per feed')
+    p.add_argument('--keep-days', type=float, metavar='DAYS',
+                   help='keep read entries younger than this')
+    p.add_argument('--vacuum', nargs='?', const='free',
+                   choices=('free', 'full'),
+                   help='release free space to shrink the database file, '
+                   'or rebuild it in full (slow, locks the database)')
+    p.add_argument('--search', metavar='QUERY', type=util.utf8,
+                   help='list entries matching words, best first')
+    p.add_argument('--limit', type=int, default=10,
+                   help='number of search results to show')
+    p.add_argument('--offset', type=int, default=0,
+                   help='number of search results to skip')
+    p.add_argument('--recount', action='store_true',
+                   help='check and rebuild maintained entry counts')
+    p.add_argument('--backfill', action='store_true',
+                   help='compute missing plaintext summaries')
+    p.add_argument('--check-plans', action='store_true',
+                   help='check that frequent queries use indexes')
+    p.add_argument('--stats', nargs='?', const='-', metavar='JSON_FILE',
+                   help='write statement and refresh timings as JSON '
+                   '(default: standard output)')
+    p.add_argument('--slow', type=float, metavar='MS',
+                   help='log statements slower than this to standard error')
     p.add_argument('--verbose', '-v', action='count',
                    help='be more verbose')
     return p.parse_args()
@@ -45,7 +112,7 @@ def print_feeds(db, ids, v):
     if ids:
         xs = (db.get_feed(i) for i in ids)
     else:
-        xs = db.get_feeds()
+        xs = db.iter_feeds()
     for x in xs:
         print(feed_util.describe(x, v))
 
@@ -55,11 +122,50 @@ def print_entries(db, ids, v):
     if ids:
         xs = (db.get_entry(i) for i in ids)
     else:
-        xs = db.get_entries()
+        xs = db.iter_entries()
     for x in xs:
         print(feed_util.describe(x, v))
 
 
+def mark(db, progress, ids, v, feed=None, cat=None, days=None):
+    """Set progress of selected entries."""
+    older = None
+    if days is not None:
+        older = util.now() - int(days * 24 * 60 * 60)
+    try:
+        n = db.write(db.mark_progress, progress, ids=ids or None, feed=feed,
+                     cat=cat, older=older)
+    except ValueError as e:
+        raise SystemExit('Cannot mark entries: {}'.format(e))
+    if v:
+        print('Set progress {p} for {n} entries.'.format(p=progress, n=n))
+
+
+def prune(db, v, keep=None, days=None):
+    """Delete old read entries."""
+    try:
+        n = db.prune(keep=keep, days=days)
+    except ValueError as e:
+        raise SystemExit('Cannot prune: {}'.format(e))
+    if v:
+        print('Pruned {} read entries.'.format(n))
+
+
+def vacuum(db, v, full=False):
+    """Shrink the database file."""
+    n = db.vacuum(full=full)
+    if v:
+        print('Released {} free pages.'.format(n))
+
+
+def search(db, text, v, limit=10, offset=0):
+    """Print entries matching text."""
+    if v:
+        print('{} entries found.'.format(db.n_matches(text)))
+    for x in db.search(text, limit=limit, offset=offset):
+        print(feed_util.describe(x, v))
+
+
 def add_feed(db, params, v):
     """Add feed tuple."""
     category, priority, url = params
@@ -68,6 +174,44 @@ def add_feed(db, params, v):
     db.add_feed(url, category, int(priority))
 
 
+def import_feeds(db, filenames, v, category=None, priority=0):
+    """Add feeds from CSV or OPML files in one transaction."""
+    def subscriptions():
+        for filename in filenames:
+            with open(filename, 'rb') as f:
+                if feed_io.is_opml(filename):
+                    rows = feed_io.read_opml(f, category or feed_io.CATEGORY,
+                                             priority)
+                else:
+                    rows = feed_io.read_csv(f)
+                for row in rows:
+                    yield row
+
+    try:
+        feeds = feed_io.unique(subscriptions())
+    except (ValueError, SyntaxError) as e:  # Includes XML ParseError.
+        raise SystemExit('Nothing imported: {}'.format(e))
+    n = db.import_feeds(feeds)
+    if v:
+        print('Imported {n} feeds, {nn} of them new.'.format(n=len(feeds),
+                                                             nn=n))
+
+
+def export_feeds(db, filename, v, category=None):
+    """Write feeds to CSV or OPML file."""
+    feeds = db.iter_feeds(cat=category, by_category=True)
+    if filename == '-':
+        feed_io.write_csv(sys.__stdout__, feeds)
+        return
+    with open(filename, 'wb') as f:
+        if feed_io.is_opml(filename):
+            feed_io.write_opml(f, feeds)
+        else:
+            feed_io.write_csv(f, feeds)
+    if v:
+        print('Exported feeds to {}.'.format(filename))
+
+
 def remove_feed(db, i, v):
     """Remove feed."""
     if v:
@@ -76,71 +220,207 @@ def remove_feed(db, i, v):
     db.remove_feed(i)
 
 
-def refresh(db, feed_ids, v):
+def refresh(db, feed_ids, v, jobs=1, per_host=feed_fetch.PER_HOST,
+            procs=None, batch=feed_db.BATCH, due=False, stats=None,
+            cache=None):
     """Refresh feeds."""
     if feed_ids:
         feeds = [db.get_feed(i) for i in sorted(feed_ids)]
+    elif due:
+        feeds = db.get_due_feeds(util.now())
     else:
         feeds = db.get_feeds()
     if v > 1:
         debug = print
     else:
         debug = None
-    d = dict(nf=len(feeds), ne=0)
+    d = dict(nf=len(feeds), ne=0, nw=0, nu=0)
     if v:
         print('Starting refresh for {nf} feeds.'.format(**d))
-    for f in feeds:
-        i = f['id']
-        try:
-            feed, entries = feed_util.parse_url(f['url'], etag=f['etag'],
-                                                modified=f['modified'],
-                                                debug=debug)
-            if feed is None and entries is None:
+    if jobs > 1:
+        results = feed_refresh.pipeline(feeds, jobs=jobs, per_host=per_host,
+                                        procs=procs, debug=debug,
+                                        stats=stats, cache=cache)
+    else:
+        results = feed_refresh.sequential(feeds, debug=debug, stats=stats,
+                                          cache=cache)
+    schedules = []
+    items = updated_feeds(results, schedules, d, v)
+    d['ne'], d['nw'] = db.refresh_feeds(items, batch=batch,
+                                        schedules=schedules)
+    if v:
+        print('Completed refresh for {nf} feeds, {ne} entries.'.format(**d))
+        msg = ('Skipped {nu} unchanged feeds and {ns} unchanged entries, '
+               'wrote {nw} entries.')
+        print(msg.format(ns=d['ne'] - d['nw'], **d))
+
+
+def reingest(db, cache, feed_ids, v, batch=feed_db.BATCH):
+    """Parse feeds again from their newest cached documents, offline."""
+    if feed_ids:
+        feeds = [db.get_feed(i) for i in sorted(feed_ids)]
+    else:
+        feeds = db.get_feeds()
+    d = dict(nf=0, ne=0, nw=0, nm=0)
+
+    def items():
+        for f in feeds:
+            response = cache.latest(f['url'])
+            if response is None:
+                d['nm'] += 1
                 if v:
-                    print(u'Feed already up-to-date: {}'.format(f['url']))
-                    continue
-            else:
-                db.refresh_feed(i, feed, entries)
-        except (IOError, ValueError) as e:
+                    print(u'No cached document for {}'.format(f['url']))
+                continue
+            try:
+                feed, entries = feed_util.parse_response(response)
+            except (IOError, ValueError) as e:
+                if v:
+                    print(u'Error parsing feed {i}: {e}'.format(i=f['id'],
+                                                                e=e))
+                continue
+            d['nf'] += 1
+            yield f['id'], feed, entries
+
+    d['ne'], d['nw'] = db.refresh_feeds(items(), batch=batch, force=True)
+    if v:
+        msg = ('Reingested {nf} feeds, {ne} entries, wrote {nw} entries. '
+               '{nm} feeds were not cached.')
+        print(msg.format(**d))
+
+
+def updated_feeds(results, schedules, d, v):
+    """Yield (feed_id, feed, entries) for every feed, feed None if unchanged.
+
+    The next refresh of every feed is scheduled into schedules, and
+    unchanged feeds are counted into d['nu'].
+    """
+    for f, result, error in results:
+        i = f['id']
+        schedule = feed_schedule.schedule(f, result, error, util.now())
+        schedules.append((i,) + schedule)
+        if error is not None:
+            if v:
+                print(u'Error parsing feed {i}: {e}'.format(i=i, e=error))
+            yield i, None, []
+            continue
+        feed, entries = result
+        if not feed:
+            d['nu'] += 1
             if v:
-                print(u'Error parsing feed {i}: {e}'.format(i=i, e=e))
+                print(u'Feed already up-to-date: {}'.format(f['url']))
+            yield i, None, []
             continue
         if v:
-            print(u'Saved feed {i} with {n} entries from {t}.'.format(
+            print(u'Saving feed {i} with {n} entries from {t}.'.format(
                 i=i, n=len(entries), t=f['title']))
-        d['ne'] += len(entries)
+        yield i, feed, entries
+
+
+def recount(db, v):
+    """Check maintained entry counts, rebuild if they are inconsistent."""
+    wrong = db.check_counts()
     if v:
-        print('Completed refresh for {nf} feeds, {ne} entries.'.format(**d))
+        for i, stored, actual in wrong:
+            print(u'Feed {i} counts {s} should be {a}.'.format(i=i, s=stored,
+                                                               a=actual))
+    if wrong:
+        db.write(db.rebuild_counts)
+        print('Rebuilt entry counts, {} feeds were wrong.'.format(len(wrong)))
+
+
+def backfill(db, v):
+    """Compute plaintext summaries for rows stored without them."""
+    nf, ne = db.backfill_summaries(feed_util.summarize)
+    if v:
+        msg = 'Computed summaries for {nf} feeds and {ne} entries.'
+        print(msg.format(nf=nf, ne=ne))
+
+
+def check_plans(db, v):
+    """Check query plans, exit with error on full table scans."""
+    if v:
+        for name, query, params in feed_db.hot_queries():
+            print(name)
+            for detail in db.explain(query, params):
+                print('    ' + detail)
+    scans = db.full_scans()
+    if scans:
+        lines = [u'{}: {}'.format(*x) for x in scans]
+        raise SystemExit('Full table scans:\n' + '\n'.join(lines))
+
+
+def write_stats(stats, filename):
+    """Write statistics as JSON."""
+    s = json.dumps(stats.summary(), indent=2, sort_keys=True)
+    if filename == '-':
+        print(s)
+    else:
+        with open(filename, 'wb') as f:
+            f.write(s + '\n')
 
 
 def main():
     util.install_utf8_conversion()
     args = parse_args()
-    db = feed_db.FeedDb(args.file)
+    stats = None
+    if args.stats or args.slow is not None:
+        slow = None if args.slow is None else args.slow / 1000
+        stats = feed_stats.Stats(slow=slow)
+    db = feed_db.FeedDb(args.file, stats=stats)
+    cache = None
+    if args.cache:
+        cache = feed_cache.BodyCache(args.cache, keep=args.cache_keep,
+                                     max_size=int(args.cache_size * 1024 *
+                                                  1024))
+    elif args.reingest is not None:
+        raise SystemExit('Option --reingest needs --cache.')
 
     # Add and remove.
     for s in args.add or []:
         params = [x.strip().strip('"') for x in s.split(',')]
         add_feed(db, params, args.verbose)
-    for f in args.addcsv or []:
-        with open(f, 'rb') as csvfile:
-            for row in csv.reader(csvfile):
-                add_feed(db, row, args.verbose)
+    if args.addcsv or args.imports:
+        import_feeds(db, (args.addcsv or []) + (args.imports or []),
+                     args.verbose, category=args.category,
+                     priority=args.priority)
     for i in args.remove or []:
         remove_feed(db, i, args.verbose)
 
     # Refresh.
     if args.refresh is not None:
-        refresh(db, args.refresh, args.verbose)
+        refresh(db, args.refresh, args.verbose, jobs=args.jobs,
+                per_host=args.per_host, procs=args.procs,
+                batch=args.batch, due=args.due, stats=stats, cache=cache)
+    if args.reingest is not None:
+        reingest(db, cache, args.reingest, args.verbose, batch=args.batch)
 
     # List things.
+    if args.export:
+        export_feeds(db, args.export, args.verbose, category=args.category)
     if args.feeds is not None:
         print_feeds(db, args.feeds, args.verbose)
     if args.entries is not None:
         print_entries(db, args.entries, args.verbose)
     if args.categories:
-        for cat in db.get_categories():
-            print(cat, str(db.n_entries(maxprg=0, cat=cat)))
+        for x in db.category_stats():
+            print(x['category'], str(x['n_unread']))
+
+    # Mark entries.
+    for progress, ids in ((1, args.markread), (0, args.markunread)):
+        if ids is not None:
+            mark(db, progress, ids, args.verbose, feed=args.feed_id,
+                 cat=args.category, days=args.older_than)
+
+    # Delete old entries and shrink file.
+    if args.prune:
+        prune(db, args.verbose, keep=args.keep, days=args.keep_days)
+    if args.vacuum:
+        vacuum(db, args.verbose, full=args.vacuum == 'full')
+
+    # Search entries.
+    if args.search is not None:
+        search(db, args.search, args.verbose, limit=args.limit,
+               offset=args.offset)
 
     # Print entry.
     if args.get:
@@ -148,15 +428,31 @@ def main():
                                       limit=1, priority=1))
         print(feed_util.describe(entry, 1))
 
+    # Check entry counts.
+    if args.recount:
+        recount(db, args.verbose)
+
+    # Fill in summaries.
+    if args.backfill:
+        backfill(db, args.verbose)
+
+    # Check query plans.
+    if args.check_plans:
+        check_plans(db, args.verbose)
+
     # Print general info.
     if args.verbose:
         msg = 'Database contains {nf} feeds, {ne} entries, {nu} unread.'
         print(msg.format(nf=db.n_feeds(), ne=db.n_entries(maxprg=1),
                          nu=db.n_entries(maxprg=0)))
 
+    if cache is not None:
+        cache.close()
     total_changes = db.close()
     if args.verbose:
         print('Changes within this session: {}.'.format(total_changes))
+    if args.stats:
+        write_stats(stats, args.stats)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,45 @@
 """Parsing feeds and handling them as objects."""
 
 from __future__ import absolute_import, division, print_function
+import hashlib
+import json
 import time
 
 import feedparser
 
+import feed_schedule
 import util
 
 
+# Entry fields that tell whether an entry has changed.
+ENTRY_CONTENT = ('updated', 'title', 'description', 'link', 'enc_url',
+                 'enc_length', 'enc_type')
+SUMMARY_LENGTH = 500  # Maximum length of plaintext summaries.
+
+
 def parse_url(url, etag, modified, debug=None):
     """Parse a feed and its entries."""
     d = feedparser.parse(url, etag=etag, modified=modified)
-    status = d.get('status', -1)
+    return parse_result(url, d, d.get('status', -1), debug)
+
+
+def parse_response(response, debug=None):
+    """Parse a feed and its entries from an already fetched response."""
+    if response.status == 304:
+        return False, False  # No need to download. Don't change anything.
+    # The final URL is the base of relative links, as when feedparser fetches.
+    headers = dict(response.headers)
+    headers.setdefault('content-location', response.href)
+    d = feedparser.parse(response.body, response_headers=headers)
+    d['href'] = response.href
+    feed, entries = parse_result(response.url, d, response.status, debug)
+    if feed:
+        feed['body_hash'] = response.body_hash
+    return feed, entries
+
+
+def parse_result(url, d, status, debug=None):
+    """Handle a parse result from feedparser."""
     if status == -1:
         if 'bozo_exception' in d:
             raise d['bozo_exception']
@@ -25,6 +53,12 @@ def parse_url(url, etag, modified, debug=None):
         debug('Redirection from {} to {}'.format(url, href))
 
     feed = parse_feed(url, d.feed)
+    feed['etag'] = d.get('etag')
+    feed['modified'] = d.get('modified')
+    feed['body_hash'] = None
+    feed['bozo'] = bool(d.get('bozo'))  # Possibly missing some entries.
+    feed['max_age'] = feed_schedule.cache_hint(d.get('headers', {}),
+                                               d.feed.get('ttl'))
     entries = [parse_entry(e, debug) for e in d.entries]
     if entries:
         # Set feed publish time as newest entry publish time.
@@ -45,6 +79,7 @@ def parse_feed(url, x):
         link=x.get('link', '(no link)'),
         description=x.get('description', '(no description)'),
         )
+    d['summary'] = summarize(d['description'])
     return d
 
 
@@ -63,9 +98,22 @@ def parse_entry(x, debug=None):
         enc_length=enc_length,
         enc_type=enc_type,
         )
+    d['summary'] = summarize(d['description'])
+    d['hash'] = content_hash(d, ENTRY_CONTENT)
     return d
 
 
+def summarize(description):
+    """Return plaintext summary of a description for listings."""
+    return util.plaintext(description or '', SUMMARY_LENGTH)
+
+
+def content_hash(d, keys):
+    """Return a hash of the given fields."""
+    s = json.dumps([d[k] for k in keys])
+    return hashlib.sha1(s).hexdigest()
+
+
 def get_updated(x):
     """Get updated field or current time as seconds."""
     # TODO: Feeds have 'updated_parsed', is it the same?
@@ -88,16 +136,22 @@ def field_fmt(k, v):
     """Return object field name and value formatted."""
     if k == 'refreshed' or k == 'updated':
         v = util.time_fmt(v)
+    elif k == 'summary':
+        v = (v or '')[:66]
     elif k == 'description':
-        v = util.HTMLStripper.strip(util.first_line(v or str(v)))[:66]
+        v = summarize(util.first_line(v or str(v)))[:66]
     return k, unicode(v)
 
 
 def describe(x, verbosity):
     """Describe a feed or an entry."""
     if verbosity:
-        max_keylen = max(len(k) for k in x.keys())
-        pairs = [field_fmt(k, x[k]) for k in x.keys()]
+        keys = x.keys()
+        if ('description' in keys and 'summary' in keys and
+                x['summary'] is not None):
+            keys.remove('description')  # Summary already shows it.
+        max_keylen = max(len(k) for k in keys)
+        pairs = [field_fmt(k, x[k]) for k in keys]
         s = u'{k:{l}}: {v}'
         lines = [s.format(k=k, v=v, l=max_keylen) for k, v in pairs]
         return '\n'.join(lines) + '\n'
@@ -1,13 +1,56 @@
-"""Generate HTML."""
+"""Generate HTML.
+
+The i-prefixed functions are generators yielding the markup in chunks, so
+that big pages can be streamed out in linear time. Text content must be
+escaped by the caller with escape(); attribute values are escaped here.
+"""
 
 from __future__ import absolute_import, division, print_function
 from __future__ import unicode_literals
+import cgi
 
 IND = ' '*4  # Indentation.
+BUFSIZE = 16 * 1024  # Number of characters to buffer before writing out.
+
+
+class Writer(object):
+    """Buffered output of text chunks to a write function."""
+    def __init__(self, out, size=BUFSIZE):
+        self.out = out
+        self.size = size
+        self.chunks = []
+        self.n = 0
+
+    def write(self, s):
+        self.chunks.append(s)
+        self.n += len(s)
+        if self.n >= self.size:
+            self.flush()
+
+    def writelines(self, chunks):
+        for s in chunks:
+            self.write(s)
+
+    def flush(self):
+        """Write out buffered chunks at once."""
+        if self.chunks:
+            self.out(''.join(self.chunks))
+            self.chunks = []
+            self.n = 0
+
+
+def escape(s):
+    """Escape text for use in content or attribute value."""
+    return cgi.escape('{}'.format(s), True)
+
+
+def attrs(attributes):
+    return ''.join(' {k}="{v}"'.format(k=k, v=escape(v))
+                   for k, v in attributes)
 
 
 def tag(name, content=None, *attributes):
-    a = ''.join(' {k}="{v}"'.format(k=k, v=v) for k, v in attributes)
+    a = attrs(attributes)
     if content:
         s = '<{n}{a}>{c}</{n}>'
     else:
@@ -19,22 +62,42 @@ def href(link, content):
     return tag('a', content, ('href', link))
 
 
-def ulist(items):
-    s = '\n'
+def iulist(items):
+    yield '<ul>\n'
     for item in items:
-        s += IND + tag('li', item) + '\n'
-    return tag('ul', s)
+        yield IND + tag('li', item) + '\n'
+    yield '</ul>'
 
 
-def table(rows, headers=None):
-    s = '\n'
+def ulist(items):
+    return ''.join(iulist(items))
+
+
+def row(items, cell='td'):
+    """Return table row as one chunk."""
+    return IND + tag('tr', ''.join(tag(cell, s) for s in items)) + '\n'
+
+
+def itable(rows, headers=None):
+    yield '<table>\n'
     if headers:
-        row = ''.join(tag('th', s) for s in headers)
-        s += IND + tag('tr', row) + '\n'
+        yield row(headers, cell='th')
     for items in rows:
-        row = ''.join(tag('td', s) for s in items)
-        s += IND + tag('tr', row) + '\n'
-    return tag('table', s)
+        yield row(items)
+    yield '</table>'
+
+
+def table(rows, headers=None):
+    return ''.join(itable(rows, headers))
+
+
+def form(action, content, method='get'):
+    return tag('form', content, ('action', action), ('method', method))
+
+
+def input_field(kind, name, value=''):
+    return tag('input', None, ('type', kind), ('name', name),
+               ('value', value))
 
 
 def head_redirect(link, time=0):
@@ -65,7 +128,7 @@ def head(title, sheet='', redirect=''):
 {redirect}
 </head>
 <body>'''
-    return s.format(title=title, sheet=sheet, redirect=redirect)
+    return s.format(title=escape(title), sheet=sheet, redirect=redirect)
 
 
 def tail():
@@ -0,0 +1,407 @@
+"""Web UI for reading feeds, independent of the server interface."""
+
+from __future__ import absolute_import, division, print_function
+import hashlib
+from operator import itemgetter
+
+import feed_db
+import html
+import util
+
+DBFILE = '_reader.db'  # Database filename.
+SHEET = 'reader.css'  # Stylesheet filename.
+
+
+def make_args(scriptname):
+    """Create URL argument definitions."""
+    args = util.CGIArgs(scriptname)
+    args.add_arg('foo')  # Temporary.
+    args.add_arg('action', default='cats')  # What to do.
+    args.add_arg('minprg', decoder=int, default=0)  # Min progress to show.
+    args.add_arg('maxprg', decoder=int, default=0)  # Max progress to show.
+    args.add_arg('limit', decoder=int, default=5)  # How many entries to show.
+    args.add_arg('cat')  # Feed category.
+    args.add_arg('feed', decoder=int)  # Feed id.
+    args.add_arg('markread', decoder=util.int_tokens,
+                 encoder=util.token_str)  # Entries mark read.
+    args.add_arg('markfeed', decoder=int)  # Feed whose entries mark read.
+    args.add_arg('markcat')  # Category whose entries mark read.
+    args.add_arg('priority', decoder=int, default=1)  # Sort by score?
+    args.add_arg('after', decoder=util.signed_int_tokens,
+                 encoder=util.token_str)  # Page after this entry key.
+    args.add_arg('before', decoder=util.signed_int_tokens,
+                 encoder=util.token_str)  # Page before this entry key.
+    args.add_arg('q', decoder=util.utf8, encoder=util.url_quote)  # Search.
+    args.add_arg('offset', decoder=int, default=0)  # Search results to skip.
+    return args
+
+
+def validator(args, db):
+    """Return ETag and Last-Modified of the requested page.
+
+    They depend on the request arguments and the change generation of the
+    database. Return None for requests that change the database.
+    """
+    if (args['action'] == 'redirect' or args['markread'] or
+            args['markfeed'] or args['markcat']):
+        return None
+    generation, modified = db.generation()
+    s = '{}\n{}'.format(generation, args.link())
+    etag = '"{}"'.format(hashlib.sha1(s).hexdigest())
+    return etag, util.time_fmt(modified, fmt='http')
+
+
+def is_fresh(v, if_none_match):
+    """Tell whether client has the page of validator v cached."""
+    if v is None or not if_none_match:
+        return False
+    tags = [x.strip() for x in if_none_match.split(',')]
+    return v[0] in tags or '*' in tags
+
+
+def cache_headers(v):
+    """Return response headers for validator v."""
+    if v is None:
+        return [('Cache-Control', 'no-store')]
+    etag, modified = v
+    return [('ETag', etag), ('Last-Modified', modified),
+            ('Cache-Control', 'no-cache')]
+
+
+def mark_read(db, selections):
+    """Mark entries read, each selection with one statement."""
+    for kwargs in selections:
+        db.mark_progress(1, **kwargs)
+
+
+class Reader(object):
+    """Page renderer for one request, writing text chunks to out."""
+    def __init__(self, args, db, out):
+        self.args = args
+        self.db = db
+        self.writer = html.Writer(out)
+
+    def emit(self, s=''):
+        self.writer.write(s)
+        self.writer.write('\n')
+
+    def emit_all(self, chunks):
+        self.writer.writelines(chunks)
+        self.writer.write('\n')
+
+    def run(self):
+        """Apply requested changes and show requested page."""
+        args, db = self.args, self.db
+        selections = [dict(ids=args['markread']),
+                      dict(feed=args['markfeed']), dict(cat=args['markcat'])]
+        selections = [x for x in selections if any(x.values())]
+        if selections:
+            db.write(mark_read, db, selections)
+        action = args['action']
+        if action == 'cats':
+            self.show_categories()
+        elif action == 'feeds':
+            self.show_feeds()
+        elif action == 'entries':
+            self.show_entries()
+        elif action == 'redirect':
+            self.show_redirect()
+        elif action == 'search':
+            self.show_search()
+        else:
+            raise ValueError('Unknown action: {}'.format(action))
+        self.writer.flush()
+
+    def link(self, **kwargs):
+        """Create a link to another page, dropping page-specific state."""
+        d = dict(markread=None, markfeed=None, markcat=None, after=None,
+                 before=None, offset=None)
+        d.update(kwargs)
+        return self.args.link(**d)
+
+    def link_cats(self):
+        return self.link(action='cats', cat=None, feed=None)
+
+    def link_feeds(self, cat=None):
+        return self.link(action='feeds', cat=cat, feed=None)
+
+    def link_entries(self, cat=None, feed=None):
+        return self.link(action='entries', cat=cat, feed=feed)
+
+    def link_page(self, after=None, before=None):
+        return self.link(action='entries', after=after, before=before)
+
+    def link_search(self, offset=None):
+        return self.link(action='search', offset=offset)
+
+    def link_redirect(self):
+        return self.link(action='redirect')
+
+    def link_markread(self, ids):
+        return self.args.link(markread=ids)
+
+    def link_markfeed(self, feed):
+        return self.link(markfeed=feed)
+
+    def link_markcat(self, cat):
+        return self.link(markcat=cat)
+
+    def print_top(self, ids=None):
+        elems = [
+            html.href(self.link_cats(), 'Categories'),
+            html.href(self.link_feeds(), 'Feeds'),
+            html.href(self.link_entries(), 'Entries'),
+            html.href(self.link_redirect(), 'Redirect'),
+            html.href(self.link_search(), 'Search'),
+            ]
+        if ids:
+            elems.append(html.href(self.link_markread(ids), 'Mark these read'))
+        self.emit('<div id="top">')
+        self.emit(' | '.join(elems))
+        self.emit('</div>')
+
+    def print_bottom(self, ids=None):
+        self.emit('<div id="bottom">')
+        if ids:
+            self.emit(html.href(self.link_markread(ids), 'Mark these read'))
+        self.emit('</div>')
+
+    def print_feedinfo(self, f, n_unread, n_total):
+        self.emit('<div class="feedinfo">')
+        d = dict(
+            id=f['id'],
+            title=html.href(self.link_entries(feed=f['id']),
+                            html.escape(f['title'])),
+            site=html.href(f['link'], '&rarr;'),
+            feed=html.href(f['url'], '&loz;'),
+            nu=n_unread, nt=n_total,
+            u=util.time_fmt(f['updated']), r=util.time_fmt(f['refreshed']),
+            cat=html.href(self.link_feeds(cat=f['category']),
+                          html.escape(f['category'])),
+            pri=f['priority'],
+            mark=html.href(self.link_markfeed(f['id']), 'mark read'),
+            )
+        rows = [
+            u'{id}: {title} {site} {feed}',
+            u'Category {cat}, priority {pri}',
+            u'{nu} unread ({mark}), {nt} total' if n_unread else
+            u'{nu} unread, {nt} total',
+            u'Updated {u}, refreshed {r}',
+            ]
+        rows = [r.format(**d) for r in rows]
+        par = html.tag('p', html.tag('br').join(rows))
+        self.emit(par)
+        self.emit('</div>')
+
+    def print_feed(self, f, n_unread, n_total):
+        self.emit('<div class="feed">')
+        self.print_feedinfo(f, n_unread, n_total)
+        self.print_description(f['description'], f['summary'],
+                               plaintext=True)
+        self.emit('</div>')
+
+    def print_entryinfo(self, e):
+        d = dict(updated=html.tag('em', util.time_fmt(e['updated'])),
+                 cat=html.href(self.link_entries(cat=e['category']),
+                               html.escape(e['category'])),
+                 feed=html.href(self.link_entries(feed=e['feed_id']),
+                                html.escape(e['feed_title'])),
+                 flink=html.href(e['feed_link'], '&rarr;'))
+        self.emit('<div class="entryinfo">')
+        s = u'{updated} &mdash; {cat} &mdash; {feed} {flink}'
+        self.emit(s.format(**d))
+        self.emit('</div>')
+
+    def print_title(self, x):
+        self.emit('<div class="title">')
+        self.emit(html.href(x['link'], html.escape(x['title'])))
+        self.emit('</div>')
+
+    def print_description(self, desc, summary=None, plaintext=False):
+        if plaintext and summary is not None:
+            desc = html.escape(summary)
+        elif plaintext and desc:
+            desc = html.escape(util.plaintext(desc))  # Not backfilled yet.
+        if desc:
+            self.emit('<div class="description">')
+            self.emit(desc)
+            self.emit('</div>')
+
+    def print_enclosure(self, e):
+        url = e['enc_url']
+        if url:
+            d = dict(t=html.escape(e['enc_type'] or 'unknown'),
+                     l=html.escape(e['enc_length'] or 'unknown'))
+            self.emit('<div class="enclosure">')
+            s = 'Enclosure (type: {t}, length: {l})'
+            self.emit(html.href(url, s.format(**d)))
+            self.emit('</div>')
+
+    def print_entry(self, e, desc, cls=0):
+        classes = 'entry', 'entry_alt'
+        self.emit('<div class="{}">'.format(classes[cls]))
+        self.print_entryinfo(e)
+        self.print_title(e)
+        self.print_description(desc)
+        self.print_enclosure(e)
+        self.emit('</div>')
+
+    def print_entries(self, entries):
+        """Print entries in full, loading their descriptions at once."""
+        descriptions = self.db.get_descriptions(e['id'] for e in entries)
+        self.emit('<div id="entries">')
+        for i, e in enumerate(entries):
+            self.print_entry(e, descriptions.get(e['id']), cls=i % 2)
+        self.emit('</div>')
+
+    def category_rows(self):
+        """Yield category table rows, with totals as the last one."""
+        nf = nu = nt = 0
+        for x in self.db.category_stats():
+            cat = x['category']
+            nf += x['n_feeds']
+            nu += x['n_unread']
+            nt += x['n_total']
+            yield [
+                html.href(self.link_entries(cat=cat), html.escape(cat)),
+                html.href(self.link_feeds(cat=cat), str(x['n_feeds'])),
+                str(x['n_unread'] or '&nbsp;&middot;&nbsp;'),
+                str(x['n_total'] or '&nbsp;&middot;&nbsp;'),
+                html.href(self.link_markcat(cat), 'Mark read')
+                if x['n_unread'] else '&nbsp;',
+                ]
+        yield [
+            html.href(self.link_entries(), 'All'),
+            html.href(self.link_feeds(), str(nf)),
+            str(nu),
+            str(nt),
+            '&nbsp;',
+            ]
+
+    def show_categories(self):
+        headers = ['Category', 'Feeds', 'Unread', 'Total', '']
+        self.emit(html.head('Categories', SHEET))
+        self.print_top()
+        self.emit('<div id="categories">')
+        self.emit_all(html.itable(self.category_rows(), headers))
+        self.emit('</div>')
+        self.print_bottom()
+        self.emit(html.tail())
+
+    def show_feeds(self):
+        args, db = self.args, self.db
+        feeds = db.feed_stats(args['cat'])
+        feeds = sorted(feeds, key=itemgetter('priority', 'updated', 'title'))
+        title = 'Feeds ({cat})'.format(cat=args['cat'] or 'all')
+        self.emit(html.head(title, SHEET))
+        self.print_top()
+        self.emit('<div id="feeds">')
+        for f in feeds:
+            if f['n_unread'] or args['maxprg'] == 1:
+                self.print_feed(f, f['n_unread'], f['n_total'])
+        self.emit('</div>')
+        self.print_bottom()
+        self.emit(html.tail())
+
+    def show_entries(self):
+        args, db = self.args, self.db
+        maxprg = args['maxprg']
+        after, before, limit = args['after'], args['before'], args['limit']
+        n = db.n_entries(maxprg=maxprg, cat=args['cat'], feed=args['feed'])
+        # Get one extra entry to know whether there is another page.
+        entries = db.get_next(maxprg=maxprg, cat=args['cat'],
+                              feed=args['feed'], limit=limit and limit + 1,
+                              priority=args['priority'], with_feed=True,
+                              after=after, before=before)
+        more = limit and len(entries) > limit
+        if more and before:
+            entries = entries[1:]
+        elif more:
+            entries = entries[:limit]
+        ids = [e['id'] for e in entries]
+        title = '{n} in entries {p:.0%} read'.format(n=n, p=maxprg)
+        self.emit(html.head(title, SHEET))
+        self.print_top(ids)
+        if entries:
+            self.print_entries(entries)
+            pages = []
+            if after or (before and more):
+                key = feed_db.entry_key(entries[0])
+                pages.append(html.href(self.link_page(before=key),
+                                       'Previous'))
+            if before or more:
+                key = feed_db.entry_key(entries[-1])
+                pages.append(html.href(self.link_page(after=key), 'Next'))
+            if pages:
+                self.emit(html.tag('p', ' | '.join(pages)))
+        else:
+            rows = ['No entries left.']
+            if args['cat'] or args['feed']:
+                rows.append(html.href(self.link_entries(),
+                                      'Show all categories'))
+            if args['feed']:
+                f = db.get_feed(args['feed'])
+                cat = f['category']
+                rows.append(html.href(self.link_entries(cat=cat),
+                                      'Show category {}'.format(cat)))
+            par = html.tag('p', html.tag('br').join(rows))
+            self.emit(par)
+        self.print_bottom(ids)
+        self.emit(html.tail())
+
+    def print_search_form(self):
+        args = self.args
+        fields = [
+            html.input_field('hidden', 'foo', args['foo'] or ''),
+            html.input_field('hidden', 'action', 'search'),
+            html.input_field('text', 'q', args['q'] or ''),
+            html.input_field('submit', 'search', 'Search'),
+            ]
+        self.emit(html.form(args.scriptname, ''.join(fields)))
+
+    def show_search(self):
+        args, db = self.args, self.db
+        q = args['q'] or u''
+        # Paging needs a positive step; bad values are not passed to SQL.
+        limit, offset = max(args['limit'], 1), max(args['offset'], 0)
+        n = db.n_matches(q)
+        entries = db.search(q, limit=limit, offset=offset)
+        ids = [e['id'] for e in entries]
+        self.emit(html.head('{n} entries found'.format(n=n), SHEET))
+        self.print_top(ids)
+        self.emit('<div id="search">')
+        self.print_search_form()
+        if q:
+            s = u'Results {a}&ndash;{b} of {n} for &ldquo;{q}&rdquo;'
+            self.emit(html.tag('p', s.format(a=min(offset + 1, n),
+                                             b=offset + len(entries), n=n,
+                                             q=html.escape(q))))
+        self.emit('</div>')
+        if entries:
+            self.print_entries(entries)
+        pages = []
+        if offset > 0:
+            pages.append(html.href(self.link_search(max(offset - limit, 0)),
+                                   'Previous'))
+        if offset + limit < n:
+            pages.append(html.href(self.link_search(offset + limit), 'Next'))
+        if pages:
+            self.emit(html.tag('p', ' | '.join(pages)))
+        self.print_bottom(ids)
+        self.emit(html.tail())
+
+    def show_redirect(self):
+        args, db = self.args, self.db
+        entries = db.get_next(maxprg=0, cat=args['cat'], feed=args['feed'],
+                              limit=1, priority=args['priority'],
+                              with_feed=True)
+        if entries:
+            e = util.sole(entries)
+            self.emit(html.head('Redirecting...', SHEET, e['link']))
+            self.emit('Redirecting to:')
+            self.print_entry(e, db.get_descriptions([e['id']]).get(e['id']))
+            db.write(db.set_progress, e['id'], 1)
+        else:
+            self.emit(html.head('Cannot redirect', SHEET))
+            self.emit('No unread entries.')
+        self.emit(html.tail())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+
+"""WSGI Web UI for reading feeds.
+
+Unlike the CGI script, this is a long-running application that keeps its
+database connection open between requests. For local use, run it with the
+standard library server.
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import cgi
+import os
+import threading
+from wsgiref.simple_server import make_server
+
+import feed_db
+import reader
+
+HTML_TYPE = 'text/html; charset=utf-8'
+CSS_TYPE = 'text/css'
+TEXT_TYPE = 'text/plain; charset=utf-8'
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('file', metavar='DB_FILE', nargs='?', default=reader.DBFILE,
+                   help='Database file name')
+    p.add_argument('--host', default='localhost',
+                   help='host name to listen on')
+    p.add_argument('--port', type=int, default=8000,
+                   help='port to listen on')
+    return p.parse_args()
+
+
+def respond(start_response, status, content_type, body, headers=()):
+    """Start response and return body as the iterable."""
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    start_response(status, [('Content-Type', content_type),
+                            ('Content-Length', str(len(body)))] +
+                   list(headers))
+    return [body]
+
+
+def make_app(filename=reader.DBFILE):
+    """Create WSGI application using given database.
+
+    Each server thread opens one connection and reuses it for its requests.
+    """
+    local = threading.local()
+    sheet = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         reader.SHEET)
+
+    def get_db():
+        if not hasattr(local, 'db'):
+            local.db = feed_db.FeedDb(filename)
+        local.db.sync()
+        return local.db
+
+    def application(environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == '/' + reader.SHEET:
+            with open(sheet, 'rb') as f:
+                return respond(start_response, '200 OK', CSS_TYPE, f.read())
+        args = reader.make_args(environ.get('SCRIPT_NAME', '') + path)
+        args.parse_form(cgi.FieldStorage(fp=environ['wsgi.input'],
+                                         environ=environ))
+        if args['foo'] != 'baz':
+            return respond(start_response, '403 Forbidden', TEXT_TYPE,
+                           'Forbidden')
+        chunks = []
+        db = get_db()
+        v = reader.validator(args, db)
+        if reader.is_fresh(v, environ.get('HTTP_IF_NONE_MATCH')):
+            start_response('304 Not Modified', reader.cache_headers(v))
+            return []
+        try:
+            reader.Reader(args, db, chunks.append).run()
+        except Exception as e:
+            db.conn.rollback()
+            return respond(start_response, '500 Internal Server Error',
+                           TEXT_TYPE, unicode(e))
+        return respond(start_response, '200 OK', HTML_TYPE,
+                       u''.join(chunks), reader.cache_headers(v))
+
+    return application
+
+
+def main():
+    args = parse_args()
+    server = make_server(args.host, args.port, make_app(args.file))
+    msg = 'Serving {f} on http://{h}:{p}/'
+    print(msg.format(f=args.file, h=args.host, p=args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
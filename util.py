@@ -5,11 +5,12 @@ import codecs
 from collections import OrderedDict
 import datetime
 from functools import partial
-from HTMLParser import HTMLParser
+from HTMLParser import HTMLParser, HTMLParseError
 from itertools import islice
 import os
 import sys
 import time
+import urllib
 
 
 class CGIArgs(object):
@@ -25,7 +26,10 @@ class CGIArgs(object):
 
     def parse(self, cgi):
         """Parse arguments from the form."""
-        form = cgi.FieldStorage()
+        self.parse_form(cgi.FieldStorage())
+
+    def parse_form(self, form):
+        """Parse arguments from given FieldStorage."""
         for name, arg in self.args.iteritems():
             value = form.getfirst(name)
             if value is None:
@@ -76,6 +80,18 @@ class HTMLStripper(HTMLParser):
         return parser.get_data()
 
 
+def plaintext(text, length=None):
+    """Strip markup and collapse whitespace, optionally shorten to length."""
+    try:
+        text = HTMLStripper.strip(text)
+    except HTMLParseError:
+        pass  # Not parseable as markup, keep it as it is.
+    text = ' '.join(text.split())
+    if length is not None and len(text) > length:
+        text = text[:length - 3].rstrip() + '...'
+    return text
+
+
 def now():
     """Get current time as seconds."""
     return int(time.time())
@@ -87,6 +103,7 @@ def time_fmt(secs=None, local=False, fmt='rfc2822'):
         iso8601='%Y-%m-%dT%H:%M %z',
         rfc2822='%a, %d %b %Y %H:%M %z',
         locale='%c',
+        http='%a, %d %b %Y %H:%M:%S GMT',
         )
     if fmt in formats:
         fmt = formats[fmt]
@@ -140,6 +157,7 @@ def tokenize(s, factory=None, filt=None, sep=',', strip=True):
 
 
 int_tokens = partial(tokenize, factory=int, filt=lambda x: x.isdigit())
+signed_int_tokens = partial(tokenize, factory=int)  # Raises ValueError.
 
 
 def token_str(tokens, sep=','):
@@ -147,6 +165,16 @@ def token_str(tokens, sep=','):
     return sep.join(str(x) for x in tokens)
 
 
+def utf8(s):
+    """Decode UTF-8 byte string, primarily meant for CGI parameters."""
+    return s.decode('utf-8')
+
+
+def url_quote(s):
+    """Quote string for use as URL parameter value."""
+    return urllib.quote_plus(s.encode('utf-8'))
+
+
 def install_utf8_conversion():
     """Install UTF-8 conversion wrapper for output."""
     if sys.stdout.encoding != 'UTF-8':